@@ -1,19 +1,226 @@
-import _thread
+import argparse
+import functools
+import hmac
 import json
-from flask_cors import CORS
-from flask import Flask, request, jsonify
+import math
 import os
+import sys
 
-from dataService.dataService import DataService, cache
+from dataService.startup import PROFILE
+
+with PROFILE.importing('flask'):
+    from flask_cors import CORS
+    from flask import Flask, Response, request, jsonify, make_response, stream_with_context
+with PROFILE.importing('dataService'):
+    from dataService.analyticsPool import AnalyticsBusyError, AnalyticsTimeoutError
+    from dataService import columnStore, encoding
+    from dataService.dataService import DataService, EDGE_MAX_PAGE_SIZE, EDGE_PAGE_SIZE
+    from dataService.ingest import IngestError
+    from dataService.metrics import METRICS
+    from dataService.responseCache import ResponseCache, cache_key, etag_for
 
 dm = DataService()
+response_cache = ResponseCache()
 app = Flask(__name__)
 CORS(app)
-cache.init_app(app, config={'CACHE_TYPE': 'simple'})
 
 FILE_ABS_PATH = os.path.dirname(__file__)
 ROOT_PATH = os.path.join(FILE_ABS_PATH, '../')
 INSIGHT_PATH = os.path.join(ROOT_PATH, 'data/insight')
+# /api/append_records is only served when this is set, and only to requests that carry it as
+# 'Authorization: Bearer <token>'; otherwise records are appended with python -m dataService.ingest
+INGEST_TOKEN = os.environ.get('V4I_INGEST_TOKEN', '')
+# 'any' keeps edges with either end among the iids asked for, 'both' those with both ends
+EDGE_MODES = ['any', 'both']
+# 'xy' is the layout in the insight table's own x/y columns
+SPATIAL_PROJECTIONS = ['xy'] + columnStore.PROJECTION_COLUMNS
+
+
+def respond(data, **kwargs):
+    # JSON text unless the client's Accept header prefers msgpack
+    with METRICS.span('serialize'):
+        if encoding.choose_mimetype(request.accept_mimetypes) == encoding.MSGPACK:
+            return Response(encoding.packb(data), mimetype=encoding.MSGPACK)
+        return json.dumps(data, **kwargs)
+
+
+def cached_response(view):
+    # for endpoints whose response only depends on their parameters and the dataset's files:
+    # bodies are kept per (endpoint, parameters, mimetype, dataset version) and carry an ETag,
+    # so a client that already has the current body gets a 304
+    @functools.wraps(view)
+    def wrapper():
+        params = request.get_json(silent=True)
+        name = params.get('dataName', params.get('name')) if isinstance(params, dict) else None
+        if name is None:
+            return view()
+        mimetype = encoding.choose_mimetype(request.accept_mimetypes)
+        key = cache_key(request.endpoint, params, mimetype, dm.registry.version(name))
+        etag = etag_for(key)
+        if request.if_none_match.contains_weak(etag):
+            METRICS.count('v4i_response_cache_total', result='not_modified')
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        entry = response_cache.get(key)
+        if entry is None:
+            response = make_response(view())
+            if response.status_code != 200:
+                return response
+            if response.is_streamed:
+                # passed on as it is produced and stored once it has been sent completely
+                chunks = response.iter_encoded()
+                response.response = _store_when_sent(chunks, key, response.mimetype)
+                response.set_etag(etag, weak=True)
+                return response
+            entry = response_cache.put(key, response.get_data(), response.mimetype)
+        coding, body = response_cache.body(entry, encoding.choose_coding(request.accept_encodings))
+        response = Response(body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag, weak=True)
+        if coding is not None:
+            response.headers['Content-Encoding'] = coding
+        return response
+    return wrapper
+
+
+def _store_when_sent(chunks, key, mimetype):
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    response_cache.put(key, b''.join(parts), mimetype)
+
+
+class ParamError(ValueError):
+    pass
+
+
+def number_param(params, key, cast, valid, description, default=None):
+    # the optional number params[key], or default; a ParamError (400) unless cast takes it and
+    # it is valid
+    value = params.get(key)
+    if value is None:
+        return default
+    try:
+        if isinstance(value, bool):
+            raise TypeError(value)
+        value = cast(value)
+        if not math.isfinite(value) or not valid(value):
+            raise ValueError(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ParamError('{} must be {}'.format(key, description))
+    return value
+
+
+def bool_param(params, key, default=False):
+    # JSON true or false only: the string 'false' would otherwise count as true
+    value = params.get(key, default)
+    if not isinstance(value, bool):
+        raise ParamError('{} must be true or false'.format(key))
+    return value
+
+
+def choice_param(params, key, choices, default=None):
+    # params[key], or default, if it is one of choices; None when both are missing
+    value = params.get(key, default)
+    if value is None and default is None:
+        return None
+    if value not in choices:
+        raise ParamError('{} must be one of {}'.format(key, ', '.join(choices)))
+    return value
+
+
+def numbers_param(params, key, length, required=False):
+    # params[key] as a list of `length` finite numbers, e.g. a point or a bounding box; None
+    # when it is missing and not required
+    values = params.get(key)
+    if values is None and not required:
+        return None
+    if not isinstance(values, list) or len(values) != length or any(
+            isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v) for v in values):
+        raise ParamError('{} must be a list of {} numbers'.format(key, length))
+    return values
+
+
+def int_list_param(params, key, required=False):
+    # the list of integers params[key]; None when it is missing and not required
+    values = params.get(key)
+    if values is None and not required:
+        return None
+    if not isinstance(values, list) or any(isinstance(v, bool) or not isinstance(v, int) for v in values):
+        raise ParamError('{} must be a list of integers'.format(key))
+    return values
+
+
+def top_k_param(params):
+    # the optional k: how many breakdown values Top1 and Attribution insights return
+    return number_param(params, 'k', int, lambda value: value > 0, 'a positive integer')
+
+
+@app.before_request
+def begin_request():
+    params = request.get_json(silent=True) if request.method == 'POST' else None
+    params = params if isinstance(params, dict) else {}
+    METRICS.begin_request(dataset=params.get('dataName', params.get('name')), iid=params.get('iid'))
+
+
+@app.after_request
+def end_request(response):
+    # unhandled exceptions get here too, as the 500 response Flask makes of them; streamed bodies
+    # are still being produced at this point and are not part of the timing
+    METRICS.end_request(request.endpoint, response.status_code)
+    return response
+
+
+@app.after_request
+def compress(response):
+    # the body also depends on the Accept header once msgpack can be negotiated
+    response.vary.add('Accept')
+    with METRICS.span('compress'):
+        return encoding.compress_response(response, request.accept_encodings)
+
+
+@app.errorhandler(AnalyticsBusyError)
+def analytics_busy(e):
+    return json.dumps({'error': str(e)}), 503
+
+
+@app.errorhandler(AnalyticsTimeoutError)
+def analytics_timeout(e):
+    return json.dumps({'error': str(e)}), 504
+
+
+@app.errorhandler(IngestError)
+def ingest_rejected(e):
+    return json.dumps({'error': str(e)}), 400
+
+
+@app.errorhandler(ParamError)
+def param_rejected(e):
+    return json.dumps({'error': str(e)}), 400
+
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    # readiness probe: passes once the datasets were preloaded and warmed up
+    if not dm.ready:
+        return json.dumps({'ready': False}), 503
+    return json.dumps({'ready': True})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = dm.get_cache_stats()
+    responses = response_cache.stats()
+    gauges = [
+        ('v4i_dataset_cache_bytes', 'Bytes held by the dataset cache, by dataset.',
+         [({'dataset': name}, nbytes) for name, nbytes in stats['datasets'].items()]),
+        ('v4i_dataset_cache_budget_bytes', 'Byte budget of the dataset cache.', [({}, stats['budget'])]),
+        ('v4i_response_cache_bytes', 'Bytes held by the response cache.', [({}, responses['nbytes'])]),
+        ('v4i_response_cache_entries', 'Responses held by the response cache.', [({}, responses['entries'])])
+    ]
+    return Response(METRICS.render(gauges), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/api/get_data_names', methods=['POST'])
@@ -23,27 +230,85 @@ def get_folder_name():
 
 
 @app.route('/api/get_data_by_name', methods=['POST'])
+@cached_response
 def get_data_by_name():
     params = request.json
     dataName = params['dataName']
-    data = dm.get_data_by_name(dataName)
-    return json.dumps(data)
+    projection = choice_param(params, 'projection', columnStore.PROJECTION_COLUMNS)
+    if params.get('stream', False) and encoding.choose_mimetype(request.accept_mimetypes) == encoding.JSON:
+        return Response(stream_with_context(dm.iter_data_by_name(dataName, projection)),
+                        mimetype='application/json')
+    data = dm.get_data_by_name(dataName, projection)
+    return respond(data)
+
+
+@app.route('/api/get_edges_by_name', methods=['POST'])
+def get_edges_by_name():
+    params = request.json
+    dataName = params['dataName']
+    data = dm.get_edges_by_name(dataName,
+                                min_jaccard=number_param(params, 'minJaccard', float, lambda value: 0 <= value <= 1,
+                                                         'a number between 0 and 1', 0.),
+                                iids=int_list_param(params, 'iids'),
+                                bbox=numbers_param(params, 'bbox', 4),
+                                projection=choice_param(params, 'projection', SPATIAL_PROJECTIONS, 'xy'),
+                                mode=choice_param(params, 'mode', EDGE_MODES, 'any'),
+                                cursor=number_param(params, 'cursor', int, lambda value: value >= 0,
+                                                    'a non-negative integer', 0),
+                                page_size=number_param(params, 'pageSize', int,
+                                                       lambda value: 0 < value <= EDGE_MAX_PAGE_SIZE,
+                                                       'an integer from 1 to {}'.format(EDGE_MAX_PAGE_SIZE),
+                                                       EDGE_PAGE_SIZE))
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/get_insights_in_range', methods=['POST'])
+def get_insights_in_range():
+    params = request.json
+    dataName = params['dataName']
+    data = dm.get_insights_in_range(dataName, numbers_param(params, 'bbox', 4, required=True),
+                                    choice_param(params, 'projection', SPATIAL_PROJECTIONS, 'xy'))
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/get_nearest_insights', methods=['POST'])
+def get_nearest_insights():
+    params = request.json
+    dataName = params['dataName']
+    data = dm.get_nearest_insights(dataName, numbers_param(params, 'point', 2, required=True),
+                                   number_param(params, 'k', int, lambda value: value > 0, 'a positive integer', 10),
+                                   choice_param(params, 'projection', SPATIAL_PROJECTIONS, 'xy'))
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/get_projection_by_name', methods=['POST'])
+@cached_response
+def get_projection_by_name():
+    params = request.json
+    dataName = params['dataName']
+    projection = choice_param(params, 'projection', columnStore.PROJECTION_COLUMNS)
+    if projection is None:
+        raise ParamError('projection is required')
+    data = dm.get_projection_by_name(dataName, projection)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_insight_count_for_record', methods=['POST'])
+@cached_response
 def get_insight_count_for_record():
     params = request.json
     dataName = params['dataName']
     data = dm.get_insight_count_for_record_by_name(dataName)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_subspace_count_for_record', methods=['POST'])
+@cached_response
 def get_subspace_count_for_record():
     params = request.json
     dataName = params['dataName']
     data = dm.get_subspace_count_for_record_by_name(dataName)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_graph_data_by_iid', methods=['POST'])
@@ -51,48 +316,72 @@ def get_graph_data_by_iid():
     params = request.json
     iid = params['iid']
     name = params['name']
-    data = dm.get_insight_by_iid(iid, name)
-    return json.dumps(data, sort_keys=False)
+    data = dm.get_insight_by_iid(iid, name, top_k_param(params))
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/get_graph_data_by_iids', methods=['POST'])
+def get_graph_data_by_iids():
+    params = request.json
+    iids = int_list_param(params, 'iids', required=True)
+    name = params['name']
+    k = top_k_param(params)
+    if params.get('stream', False):
+        def generate():
+            for iid, data, error in dm.iter_insight_by_iids(iids, name, k):
+                line = {'iid': iid, 'data': data} if error is None else {'iid': iid, 'error': error}
+                yield json.dumps(line, sort_keys=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    data = dm.get_insight_by_iids(iids, name, k)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_insight_count_for_subspace', methods=['POST'])
+@cached_response
 def get_insight_count_for_subspace():
     params = request.json
     dataName = params['dataName']
     data = dm.get_insight_count_for_subspace_by_name(dataName)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_data_info_by_name', methods=['POST'])
+@cached_response
 def get_data_info_by_name():
     params = request.json
     name = params['name']
-    data = dm.get_data_info_by_name(name)
-    return json.dumps(data, sort_keys=False)
+    approximate = bool_param(params, 'approximate')
+    sample_size = number_param(params, 'sampleSize', int, lambda value: value > 0, 'a positive integer')
+    error = number_param(params, 'error', float, lambda value: 0 < value < 1, 'a number between 0 and 1')
+    data = dm.get_data_info_by_name(name, approximate, sample_size, error)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_data_attr_map_by_name', methods=['POST'])
+@cached_response
 def get_data_attr_map_by_name():
     params = request.json
     name = params['dataName']
     data = dm.get_data_attr_map_by_name(name)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_data_feature_attribution_by_name', methods=['POST'])
+@cached_response
 def get_data_feature_attribution_by_name():
     params = request.json
     name = params['dataName']
     data = dm.get_data_feature_attribution_by_name(name)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_data_subspace_range_by_name', methods=['POST'])
+@cached_response
 def get_data_subspace_range_by_name():
     params = request.json
     name = params['dataName']
     data = dm.get_subspace_range_by_name(name)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
 
 
 @app.route('/api/get_similar_insight', methods=['POST'])
@@ -104,8 +393,37 @@ def getSimilarInsight():
     breakdown = params['breakdown']
     breakdown_value = params['breakdown_value']
     data = dm.get_similar_insight(feature, sid, name, breakdown, breakdown_value)
-    return json.dumps(data, sort_keys=False)
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/append_records', methods=['POST'])
+def append_records():
+    if not INGEST_TOKEN:
+        return json.dumps({'error': 'appending records is disabled'}), 404
+    token = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(token.encode('utf-8'), 'Bearer {}'.format(INGEST_TOKEN).encode('utf-8')):
+        return json.dumps({'error': 'a valid ingest token is required'}), 401
+    params = request.json
+    name = params['dataName']
+    data = dm.append_records(name, params['records'])
+    return respond(data, sort_keys=False)
+
+
+@app.route('/api/get_cache_stats', methods=['POST'])
+def get_cache_stats():
+    data = dm.get_cache_stats()
+    return respond(data, sort_keys=False)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='preload every dataset, print where the startup time went and exit')
+    parser.add_argument('--startup-budget', type=float,
+                        help='with --profile-startup, exit with status 1 if startup took longer (seconds)')
+    args = parser.parse_args()
+    if args.profile_startup:
+        dm.preload()
+        print(PROFILE.report(args.startup_budget))
+        sys.exit(1 if args.startup_budget is not None and PROFILE.total() > args.startup_budget else 0)
     app.run(debug=True, port=8888)
@@ -0,0 +1,177 @@
+# Endpoint benchmarks, run from the repository root:
+#     python -m benchmarks.endpoints [--datasets carSales1 Census] [--rounds 3] [--cold]
+#                                    [--response-cache] [--save bench.json] [--baseline bench.json]
+# Replays a mix of requests per dataset through the Flask test client and reports latency
+# percentiles, throughput and peak RSS per endpoint. The response cache is emptied before every
+# round, so repeated requests measure the endpoints rather than cache lookups, unless
+# --response-cache is given. With --baseline, endpoints whose p95 grew by more than --tolerance
+# are reported and the exit status is 1.
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+from dataService import columnStore
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+DEFAULT_PER_TYPE = 10
+DEFAULT_ROUNDS = 3
+DEFAULT_TOLERANCE = 0.25
+# p95 changes below this many milliseconds are noise, whatever the ratio
+MIN_DELTA_MS = 1.
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def request_mix(dm, name, per_type, rng):
+    # (endpoint, body) pairs the client sends while a user explores the dataset: the data itself,
+    # a sample of insights of every type, similar insights for them and the data info
+    dataset = dm.registry.get(name, notify=False)
+    insight = dataset.table('insight')
+    subspace = dataset.table('subspace')
+    features = subspace.columns.values.tolist()[0:-1]
+
+    mix = [('get_data_by_name', {'dataName': name}),
+           ('get_data_info_by_name', {'name': name})]
+    projections = [col for col in columnStore.PROJECTION_COLUMNS if col in insight.columns]
+    if projections:
+        mix.append(('get_data_by_name', {'dataName': name, 'projection': projections[0]}))
+    for _, group in insight.groupby('insight', sort=True):
+        rows = rng.sample(range(len(group)), min(per_type, len(group)))
+        for row in rows:
+            iid, sid = int(group['iid'].iloc[row]), int(group['sid'].iloc[row])
+            breakdown, breakdown_value = group['breakdown'].iloc[row], group['breakdown_value'].iloc[row]
+            mix.append(('get_graph_data_by_iid', {'iid': iid, 'name': name}))
+            feature = breakdown if breakdown in features else rng.choice(features)
+            mix.append(('get_similar_insight', {'name': name, 'sid': sid, 'feature': feature,
+                                                'breakdown': breakdown, 'breakdown_value': breakdown_value}))
+    return mix
+
+
+def replay(client, mix, rounds, rng, response_cache=None):
+    # response_cache: emptied before every round; None keeps the cached responses
+    timings = {endpoint: {'latency': [], 'errors': 0, 'rss_growth': 0.} for endpoint, _ in mix}
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if response_cache is not None:
+            response_cache.clear()
+        order = list(mix)
+        rng.shuffle(order)
+        for endpoint, body in order:
+            rss = _peak_rss_mb()
+            begin = time.perf_counter()
+            response = client.post('/api/' + endpoint, json=body)
+            # streamed bodies are produced while they are read
+            response.get_data()
+            timings[endpoint]['latency'].append(time.perf_counter() - begin)
+            timings[endpoint]['rss_growth'] += _peak_rss_mb() - rss
+            if response.status_code != 200:
+                timings[endpoint]['errors'] += 1
+    return timings, time.perf_counter() - start
+
+
+def summarize(timings, wall):
+    result = dict()
+    for endpoint, timing in timings.items():
+        latency = np.array(timing['latency']) * 1000.
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+        result[endpoint] = {
+            'requests': len(latency),
+            'errors': timing['errors'],
+            'p50_ms': round(float(p50), 3),
+            'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3),
+            'throughput': round(len(latency) / latency.sum() * 1000., 1) if latency.sum() > 0 else None,
+            'rss_growth_mb': round(timing['rss_growth'], 1)
+        }
+    requests = sum(len(timing['latency']) for timing in timings.values())
+    result['all'] = {'requests': requests, 'throughput': round(requests / wall, 1), 'peak_rss_mb': round(_peak_rss_mb(), 1)}
+    return result
+
+
+def report(results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    lines = ['{:<24} {:<22} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'dataset', 'endpoint', 'reqs', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'rss +MB')]
+    regressions = []
+    for name, endpoints in results.items():
+        for endpoint, stats in endpoints.items():
+            if endpoint == 'all':
+                continue
+            line = '{:<24} {:<22} {:>6} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>10} {:>8.1f}'.format(
+                name, endpoint, stats['requests'], stats['errors'], stats['p50_ms'], stats['p95_ms'],
+                stats['p99_ms'], stats['throughput'], stats['rss_growth_mb'])
+            before = (baseline or {}).get(name, {}).get(endpoint)
+            if before is not None:
+                ratio = stats['p95_ms'] / before['p95_ms'] if before['p95_ms'] > 0 else float('inf')
+                regressed = ratio > 1 + tolerance and stats['p95_ms'] - before['p95_ms'] > MIN_DELTA_MS
+                line += '  p95 x{:.2f}{}'.format(ratio, '  REGRESSED' if regressed else '')
+                if regressed:
+                    regressions.append((name, endpoint))
+            lines.append(line)
+        lines.append('{:<24} {:<22} {:>6} {:>6} {:>43} {:>10} {:>8}'.format(
+            name, 'all', endpoints['all']['requests'], '', '', endpoints['all']['throughput'],
+            'peak {:.0f}'.format(endpoints['all']['peak_rss_mb'])))
+    return '\n'.join(lines), regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', nargs='*', help='datasets to benchmark (default: every dataset in data/)')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS, help='times the request mix is replayed')
+    parser.add_argument('--per-type', type=int, default=DEFAULT_PER_TYPE,
+                        help='insights sampled per insight type')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cold', action='store_true',
+                        help='do not preload and warm up the datasets, so loads are part of the timings')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='keep cached responses between rounds, so repeats are cache hits')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative p95 growth reported as a regression')
+    args = parser.parse_args()
+
+    if args.cold:
+        # no background warm-up racing the timed requests
+        os.environ['V4I_WARM_UP_WORKERS'] = '0'
+    from app import app, dm, response_cache
+
+    names = args.datasets or sorted(dm.read_data_names())
+    if not args.cold:
+        dm.preload(names)
+    client = app.test_client()
+    results = dict()
+    for name in names:
+        rng = random.Random('{}:{}'.format(args.seed, name))
+        try:
+            mix = request_mix(dm, name, args.per_type, rng)
+        except (OSError, KeyError) as e:
+            print('skip {}: {}'.format(name, e), file=sys.stderr)
+            continue
+        timings, wall = replay(client, mix, args.rounds, rng, None if args.response_cache else response_cache)
+        results[name] = summarize(timings, wall)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    text, regressions = report(results, baseline, args.tolerance)
+    print(text)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print('{} endpoint(s) regressed beyond {:.0%}'.format(len(regressions), args.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
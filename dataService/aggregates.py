@@ -0,0 +1,39 @@
+from dataService.metrics import METRICS
+
+
+class SubspaceAggregator():
+    # sums of measures grouped by a breakdown within one subspace; every measure that will be
+    # asked for under a breakdown is summed in the same groupby, once
+    def __init__(self, record, measures_by_breakdown=None):
+        self.record = record
+        self.__measures = dict(measures_by_breakdown or {})
+        self.__groups = dict()
+
+    def aggregate(self, breakdown, measures):
+        group = self.__groups.get(breakdown)
+        if group is None or any(measure not in group.columns for measure in measures):
+            wanted = self.__measures.get(breakdown, [])
+            wanted = wanted + [measure for measure in measures if measure not in wanted]
+            self.__measures[breakdown] = wanted
+            group = self.record.groupby(breakdown, as_index=False, observed=True).agg({measure: 'sum' for measure in wanted})
+            self.__groups[breakdown] = group
+        return group[[breakdown] + list(measures)]
+
+
+class CubeAggregator():
+    # the same sums looked up in a data cube; whatever the cube does not hold is grouped from
+    # the subspace's records, built on first need
+    def __init__(self, cube, sid, fallback):
+        self.cube = cube
+        self.sid = sid
+        self.__fallback = fallback
+        self.__aggregator = None
+
+    def aggregate(self, breakdown, measures):
+        with METRICS.span('aggregate'):
+            group = self.cube.lookup(self.sid, breakdown, measures)
+            if group is not None:
+                return group
+            if self.__aggregator is None:
+                self.__aggregator = self.__fallback()
+            return self.__aggregator.aggregate(breakdown, measures)
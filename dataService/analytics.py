@@ -0,0 +1,151 @@
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+# the analytic kernels behind get_insight_by_iid, in closed form on NumPy; plain module-level
+# functions so they can be shipped to the analytics process pool
+
+
+def linear_fits(x, y):
+    # least-squares slope and intercept along the last axis, so a 2-D input fits one series per
+    # row in one call. Solved on centered data, which is what LinearRegression did; a series
+    # without spread in x gets a flat line, as lstsq gave it
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x_mean = x.mean(axis=-1, keepdims=True)
+    y_mean = y.mean(axis=-1, keepdims=True)
+    x_centered = x - x_mean
+    sxx = np.einsum('...i,...i->...', x_centered, x_centered)
+    sxy = np.einsum('...i,...i->...', x_centered, y - y_mean)
+    slope = np.divide(sxy, sxx, out=np.zeros(np.shape(sxy)), where=sxx != 0)
+    return slope, y_mean[..., 0] - x_mean[..., 0] * slope
+
+
+def linear_fit(x, y):
+    slope, intercept = linear_fits(np.ravel(x), np.ravel(y))
+    return slope[()], intercept[()]
+
+
+def linear_slope(x, y):
+    slope, _ = linear_fit(x, y)
+    return slope
+
+
+def line_endpoints(x, y):
+    # the fitted line evaluated at the first and the last x
+    slope, intercept = linear_fit(x, y)
+    return [float(x[0]) * slope + intercept, float(x[-1]) * slope + intercept]
+
+
+def pearson(y1, y2):
+    # correlation along the last axis, so 2-D input gives one r per row; nan for constant input
+    y1 = np.asarray(y1, dtype=np.float64)
+    y2 = np.asarray(y2, dtype=np.float64)
+    if y1.shape[-1] != y2.shape[-1]:
+        raise ValueError('x and y must have the same length.')
+    if y1.shape[-1] < 2:
+        raise ValueError('x and y must have length at least 2.')
+    constant = (y1 == y1[..., 0:1]).all(axis=-1) | (y2 == y2[..., 0:1]).all(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.einsum('...i,...i->...', _unit(y1), _unit(y2))
+    r = np.where(constant, np.nan, np.clip(r, -1., 1.))
+    return r[()] if r.ndim == 0 else r
+
+
+def _unit(values):
+    centered = values - values.mean(axis=-1, keepdims=True)
+    scale = np.abs(centered).max(axis=-1, keepdims=True)
+    return centered / (scale * np.linalg.norm(centered / scale, axis=-1, keepdims=True))
+
+
+def _descending(values):
+    # positions in descending order, ties in ascending position: what a stable sort gives
+    n = len(values)
+    return n - 1 - np.argsort(values[::-1], kind='stable')[::-1]
+
+
+def top_k(values, k=None):
+    # positions of the k largest values, largest first (all of them for k None); NaN go last.
+    # The order is that of sort_values(ascending=False, kind='stable'), but only the k that
+    # are kept get sorted
+    values = np.asarray(values)
+    missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), dtype=bool)
+    valid = np.flatnonzero(~missing)
+    k = len(values) if k is None else min(k, len(values))
+    if 0 < k < len(valid):
+        present = values[valid]
+        threshold = present[np.argpartition(present, len(present) - k)[len(present) - k]]
+        # everything above the k-th largest, then the earliest of those equal to it
+        above = np.flatnonzero(present > threshold)
+        at = np.flatnonzero(present == threshold)[0:k - len(above)]
+        valid = valid[np.sort(np.concatenate((above, at)))]
+    order = valid[_descending(values[valid])]
+    return np.concatenate((order, np.flatnonzero(missing)))[0:k]
+
+
+def standardize(X):
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1.
+    return (X - X.mean(axis=0)) / scale
+
+
+def _neighbour_pairs(X, eps):
+    # (i, j) of every pair of finite points at most eps apart, each point with itself included.
+    # Points are bucketed on a grid of side eps, so only those in adjacent cells are compared
+    # and memory grows with the pairs found rather than with n * n
+    rows = np.flatnonzero(np.isfinite(X).all(axis=1))
+    cell = np.floor(X[rows] / eps).astype(np.int64)
+    cell -= cell.min(axis=0, initial=0) if len(rows) else 0
+    # one spare column on either side, so stepping off the grid finds no cell
+    width = int(cell[:, 1].max(initial=0)) + 2
+    key = cell[:, 0] * width + cell[:, 1]
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    pairs_i, pairs_j = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            target = key + dx * width + dy
+            start = np.searchsorted(sorted_key, target, 'left')
+            counts = np.searchsorted(sorted_key, target, 'right') - start
+            i = np.repeat(np.arange(len(rows)), counts)
+            j = order[np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)]
+            diff = X[rows[i]] - X[rows[j]]
+            close = np.sqrt((diff * diff).sum(axis=1)) <= eps
+            pairs_i.append(rows[i[close]])
+            pairs_j.append(rows[j[close]])
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def dbscan_labels(x, y, eps=0.3, min_samples=5):
+    # DBSCAN on the standardized 2-D points, labelled the way sklearn does: clusters are numbered
+    # by their lowest core point and a border point joins the first cluster that reaches it
+    X = standardize(np.vstack((x, y)).T.astype(np.float64))
+    n = len(X)
+    i, j = _neighbour_pairs(X, eps)
+    core = np.bincount(i, minlength=n) >= min_samples
+
+    # connected components of the core points: every core point takes the smallest index among
+    # its core neighbours, then the label of that index, until nothing changes
+    linked = core[i] & core[j]
+    i_core, j_core = i[linked], j[linked]
+    component = np.append(np.where(core, np.arange(n), n), n)
+    while True:
+        updated = component.copy()
+        np.minimum.at(updated, i_core, component[j_core])
+        updated = updated[updated]
+        if np.array_equal(updated, component):
+            break
+        component = updated
+
+    roots = np.unique(component[0:n][core])
+    cluster = np.full(n + 1, -1, dtype=np.int64)
+    cluster[roots] = np.arange(len(roots))
+    labels = cluster[component[0:n]]
+    # border points: the lowest-numbered cluster among adjacent core points
+    reach = np.full(n, len(roots), dtype=np.int64)
+    to_core = ~core[i] & core[j]
+    np.minimum.at(reach, i[to_core], labels[j[to_core]])
+    border = reach < len(roots)
+    labels[border] = reach[border]
+    return labels
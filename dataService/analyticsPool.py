@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from dataService.metrics import METRICS
+
+ANALYTICS_WORKERS = int(os.environ.get('V4I_ANALYTICS_WORKERS', '2'))
+ANALYTICS_QUEUE_DEPTH = int(os.environ.get('V4I_ANALYTICS_QUEUE_DEPTH', '16'))
+ANALYTICS_TIMEOUT = float(os.environ.get('V4I_ANALYTICS_TIMEOUT', '10'))
+
+
+class AnalyticsBusyError(Exception):
+    pass
+
+
+class AnalyticsTimeoutError(Exception):
+    pass
+
+
+class AnalyticsPool():
+    # runs CPU-heavy kernels in a bounded set of processes so request threads stay responsive;
+    # a full queue is refused right away instead of piling up behind a burst
+    def __init__(self, workers=ANALYTICS_WORKERS, queue_depth=ANALYTICS_QUEUE_DEPTH, timeout=ANALYTICS_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.__slots = threading.BoundedSemaphore(queue_depth)
+        self.__executor = None
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def __get_executor(self):
+        # created on first use, i.e. inside the serving process rather than a pre-fork master
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+            return self.__executor
+
+    def __reset_executor(self, executor):
+        with self.__lock:
+            if self.__executor is executor:
+                self.__executor = None
+        executor.shutdown(wait=False)
+
+    @contextmanager
+    def inline(self):
+        # background work (warm-up, preload) computes in its own thread and leaves the pool to requests
+        self.__local.inline = True
+        try:
+            yield
+        finally:
+            self.__local.inline = False
+
+    def run(self, fn, *args):
+        with METRICS.span('analytics'):
+            return self.__run(fn, *args)
+
+    def __run(self, fn, *args):
+        if self.workers <= 0 or getattr(self.__local, 'inline', False):
+            return fn(*args)
+        if not self.__slots.acquire(blocking=False):
+            raise AnalyticsBusyError('analytics queue is full')
+        executor = self.__get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.__slots.release()
+            self.__reset_executor(executor)
+            raise
+        except Exception:
+            self.__slots.release()
+            raise
+        # the slot stays taken until the task really finishes, even if the caller gave up on it
+        future.add_done_callback(lambda _: self.__slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise AnalyticsTimeoutError('{} did not finish within {}s'.format(fn.__name__, self.timeout))
+        except BrokenProcessPool:
+            self.__reset_executor(executor)
+            raise
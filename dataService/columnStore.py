@@ -0,0 +1,299 @@
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+FILE_ABS_PATH = os.path.dirname(__file__)
+ROOT_PATH = os.path.join(FILE_ABS_PATH, '../')
+DATA_FOLDER = os.path.join(ROOT_PATH, 'data')
+STORE_FOLDER = os.path.join(DATA_FOLDER, '.columnar')
+LOCK_FOLDER = os.path.join(STORE_FOLDER, 'lock')
+
+KINDS = ['edge', 'insight', 'record', 'sid_cid', 'subspace']
+# tables whose dimension columns are served as categoricals over one dictionary per dataset
+ENCODED_KINDS = ['record', 'subspace']
+WILDCARD = '*'
+PROJECTION_COLUMNS = ['fcpE_mds', 'fcpE_se', 'fcpE_iso', 'fcpE_tsne',
+                      'rdcE_mds', 'rdcE_se', 'rdcE_iso', 'rdcE_tsne']
+FORMAT_VERSION = 3
+META_FILE = 'meta.json'
+# times a read is started over on a newer version of a table
+READ_ATTEMPTS = 3
+
+
+def csv_path(kind, name):
+    return os.path.join(DATA_FOLDER, kind, '{}_{}.csv'.format(kind, name))
+
+
+def table_path(kind, name):
+    return os.path.join(STORE_FOLDER, kind, '{}_{}'.format(kind, name))
+
+
+def source_stamp(kind, name):
+    st = os.stat(csv_path(kind, name))
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(kind, name):
+    meta = _read_meta(table_path(kind, name))
+    return meta is not None \
+        and meta['format'] == FORMAT_VERSION \
+        and meta['source'] == source_stamp(kind, name)
+
+
+def _code_dtype(n):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+@contextmanager
+def file_lock(key):
+    # one holder of key at a time, across every process on this machine; not reentrant
+    os.makedirs(LOCK_FOLDER, exist_ok=True)
+    with open(os.path.join(LOCK_FOLDER, '{}.lock'.format(key)), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store_lock(path):
+    # held while a stored directory is rebuilt and published
+    return file_lock(os.path.basename(path))
+
+
+def publish(tmp_path, path):
+    # the caller holds store_lock(path). Every build gets its own directory and path becomes a
+    # symlink to the current one, swapped atomically; readers resolve it once (resolve) and
+    # the previous version is kept for those still reading it
+    version_path = '{}@{}-{}'.format(path, time.time_ns(), os.getpid())
+    os.rename(tmp_path, version_path)
+    previous = os.readlink(path) if os.path.islink(path) else None
+    if os.path.isdir(path) and not os.path.islink(path):
+        # a directory from before versioning
+        shutil.rmtree(path)
+    link_path = '{}.link-{}'.format(path, os.getpid())
+    if os.path.lexists(link_path):
+        os.unlink(link_path)
+    os.symlink(os.path.basename(version_path), link_path)
+    os.replace(link_path, path)
+
+    folder, prefix = os.path.dirname(path), os.path.basename(path) + '@'
+    keep = {os.path.basename(version_path), previous}
+    for entry in os.listdir(folder):
+        if entry.startswith(prefix) and entry not in keep:
+            shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
+
+
+def resolve(path):
+    # the version directory path currently points to
+    return os.path.realpath(path)
+
+
+def parse_projection(values):
+    # '[-0.08, 0.11]' -> [-0.08, 0.11]; unparsable rows become NaN
+    points = values.astype(object).str.strip('[]').str.split(',', expand=True)
+    points = points.reindex(columns=[0, 1]).apply(pd.to_numeric, errors='coerce')
+    return np.ascontiguousarray(points.to_numpy(dtype=np.float32))
+
+
+def convert_table(kind, name):
+    path = table_path(kind, name)
+    with store_lock(path):
+        return _convert_table(kind, name)
+
+
+def _convert_table(kind, name):
+    stamp = source_stamp(kind, name)
+    df = pd.read_csv(csv_path(kind, name))
+
+    path = table_path(kind, name)
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if values.dtype.kind in 'biuf':
+            np.save(os.path.join(tmp_path, 'c{}.npy'.format(i)), values.to_numpy())
+            columns.append({'name': col, 'type': 'numeric'})
+        else:
+            # string columns are dictionary-coded (sorted) so they can be mapped as well
+            codes, uniques = pd.factorize(values, sort=True)
+            codes = codes.astype(_code_dtype(len(uniques)))
+            np.save(os.path.join(tmp_path, 'c{}.npy'.format(i)), codes)
+            columns.append({'name': col, 'type': 'categorical', 'categories': [str(u) for u in uniques]})
+
+    projections = []
+    if kind == 'insight':
+        for col in PROJECTION_COLUMNS:
+            if col in df.columns:
+                np.save(os.path.join(tmp_path, 'p_{}.npy'.format(col)), parse_projection(df[col]))
+                projections.append(col)
+
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump({'format': FORMAT_VERSION, 'source': stamp, 'columns': columns,
+                   'projections': projections}, f)
+    publish(tmp_path, path)
+    return path
+
+
+def append_table(kind, name, df):
+    # extends a fresh stored table by the rows of df, which were just appended to its CSV, and
+    # gives the same files convert_table would write for the CSV as it now stands
+    with store_lock(table_path(kind, name)):
+        if is_fresh(kind, name):
+            # another process already converted the CSV with the rows
+            return table_path(kind, name)
+        return _append_table(kind, name, df)
+
+
+def _append_table(kind, name, df):
+    path = table_path(kind, name)
+    source = resolve(path)
+    meta = _read_meta(source)
+    stamp = source_stamp(kind, name)
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = []
+    for i, col in enumerate(meta['columns']):
+        old = np.load(os.path.join(source, 'c{}.npy'.format(i)), mmap_mode='r')
+        values = df[col['name']]
+        if col['type'] == 'numeric':
+            np.save(os.path.join(tmp_path, 'c{}.npy'.format(i)), np.concatenate((old, values.to_numpy(dtype=old.dtype))))
+            columns.append(col)
+        else:
+            values = np.asarray(values, dtype=object)
+            present = pd.notna(values)
+            categories = sorted(set(col['categories']) | set(str(v) for v in values[present]))
+            codes = np.concatenate((_recode(old, col['categories'], categories),
+                                    pd.Index(categories).get_indexer(values.astype(str)))).astype(_code_dtype(len(categories)))
+            codes[len(old):][~present] = -1
+            np.save(os.path.join(tmp_path, 'c{}.npy'.format(i)), codes)
+            columns.append({'name': col['name'], 'type': 'categorical', 'categories': categories})
+
+    for col in meta['projections']:
+        shutil.copyfile(os.path.join(source, 'p_{}.npy'.format(col)), os.path.join(tmp_path, 'p_{}.npy'.format(col)))
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump({'format': FORMAT_VERSION, 'source': stamp, 'columns': columns,
+                   'projections': meta['projections']}, f)
+    publish(tmp_path, path)
+    return path
+
+
+def _fresh_path(kind, name):
+    # the version directory of the table, converting the CSV first if it changed; whoever
+    # waited for the lock finds the conversion another process just made
+    path = table_path(kind, name)
+    if not is_fresh(kind, name):
+        with store_lock(path):
+            if not is_fresh(kind, name):
+                _convert_table(kind, name)
+    return resolve(path)
+
+
+def _fresh_meta(kind, name):
+    return _read_meta(_fresh_path(kind, name))
+
+
+def feature_dictionary(name):
+    # one sorted dictionary per dimension column, shared by the record and subspace tables;
+    # read from the stored categories, so no column data is touched
+    values = dict()
+    for kind in ENCODED_KINDS:
+        try:
+            meta = _fresh_meta(kind, name)
+        except OSError:
+            continue
+        for col in meta['columns']:
+            if col['type'] == 'categorical':
+                values.setdefault(col['name'], set()).update(v for v in col['categories'] if v != WILDCARD)
+    return {col: sorted(v) for col, v in values.items()}
+
+
+def _recode(codes, stored, categories):
+    # stored codes -> codes into categories; -1 (missing) stays -1
+    mapping = np.append(pd.Index(categories).get_indexer(stored), -1).astype(_code_dtype(len(categories)))
+    return mapping.take(codes)
+
+
+def _read_version(kind, name, read):
+    # read(path, meta) against one version directory. A version is removed once two newer
+    # ones are published; should that happen mid-read, the read starts over on the current one
+    for attempt in range(READ_ATTEMPTS):
+        path = _fresh_path(kind, name)
+        meta = _read_meta(path)
+        try:
+            if meta is not None:
+                return read(path, meta)
+        except FileNotFoundError:
+            if attempt == READ_ATTEMPTS - 1:
+                raise
+    raise FileNotFoundError(table_path(kind, name))
+
+
+def load_table(kind, name):
+    dictionary = feature_dictionary(name) if kind in ENCODED_KINDS else None
+
+    def read(path, meta):
+        data = dict()
+        for i, col in enumerate(meta['columns']):
+            values = np.load(os.path.join(path, 'c{}.npy'.format(i)), mmap_mode='r')
+            if col['type'] == 'categorical' and dictionary is not None:
+                # the wildcard of a subspace row gets the reserved last code
+                categories = dictionary[col['name']] + ([WILDCARD] if kind == 'subspace' else [])
+                values = pd.Categorical.from_codes(_recode(values, col['categories'], categories), categories)
+            elif col['type'] == 'categorical':
+                categories = np.array(col['categories'] + [np.nan], dtype=object)
+                # code -1 marks a missing value and picks the trailing NaN
+                values = categories.take(values)
+            data[col['name']] = values
+        return pd.DataFrame(data, copy=False)
+
+    return _read_version(kind, name, read)
+
+
+def load_projections(name):
+    def read(path, meta):
+        return {col: np.load(os.path.join(path, 'p_{}.npy'.format(col)), mmap_mode='r')
+                for col in meta['projections']}
+
+    return _read_version('insight', name, read)
+
+
+def convert_all(names=None):
+    for kind in KINDS:
+        folder = os.path.join(DATA_FOLDER, kind)
+        for file_name in sorted(os.listdir(folder)):
+            name = file_name[len(kind) + 1:-len('.csv')]
+            if names and name not in names:
+                continue
+            if not is_fresh(kind, name):
+                print('convert {}'.format(os.path.relpath(csv_path(kind, name), ROOT_PATH)))
+                convert_table(kind, name)
+
+
+if __name__ == '__main__':
+    convert_all(sys.argv[1:])
@@ -0,0 +1,314 @@
+import json
+import os
+import shutil
+import sys
+
+from dataService import columnStore
+from dataService.indexes import SubspaceIndex, gather
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+CUBE_FOLDER = os.path.join(columnStore.STORE_FOLDER, 'cube')
+SOURCE_KINDS = ['insight', 'record', 'sid_cid', 'subspace']
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+# the column each dataset's Correlation insights are plotted over
+TIME_COLUMNS = {
+    'carSales1': 'Year',
+    'Emission': 'Year',
+    'Census': 'Birthday',
+    'NBA': 'year',
+}
+
+
+def cube_path(name):
+    return os.path.join(CUBE_FOLDER, 'cube_{}'.format(name))
+
+
+def cube_lock(name):
+    return columnStore.store_lock(cube_path(name))
+
+
+def _sources(name):
+    return {kind: columnStore.source_stamp(kind, name) for kind in SOURCE_KINDS}
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(name):
+    meta = _read_meta(cube_path(name))
+    return meta is not None \
+        and meta['format'] == [FORMAT_VERSION, columnStore.FORMAT_VERSION] \
+        and meta['time_col'] == TIME_COLUMNS.get(name) \
+        and meta['source'] == _sources(name)
+
+
+def plan_views(insight, time_col=None):
+    # every (where, group) aggregate the insights need: the sids it is asked for and the
+    # measures summed. Plain insights group their subspace by the breakdown; Correlation
+    # groups by time, either restricted to one breakdown value or not
+    views = dict()
+
+    def want(where, group, sid, measures):
+        view = views.setdefault((where, group), {'sids': set(), 'measures': []})
+        view['sids'].add(sid)
+        view['measures'].extend(m for m in measures if m not in view['measures'])
+
+    for sid, insight_name, breakdown, measure in zip(
+            insight['sid'].tolist(), insight['insight'].tolist(),
+            insight['breakdown'].tolist(), insight['measure'].tolist()):
+        if insight_name == 'Correlation':
+            if time_col:
+                want(breakdown, time_col, sid, [measure])
+                want(None, time_col, sid, [measure])
+        else:
+            want(None, breakdown, sid, measure.split(';'))
+    return views
+
+
+def _group_keys(values, rows):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()[rows], True
+    return values.to_numpy()[rows], False
+
+
+def build_view(record, sid_to_row, sids, columns, measures):
+    # one groupby over the records of all sids at once, keyed by (sid, *columns); rows are
+    # taken in ascending order within a sid, so every group is summed in the same order a
+    # groupby over that subspace alone would use
+    sids = np.unique(np.asarray(sids, dtype=np.int64))
+    rows, lengths = gather(sid_to_row, sids)
+    slot = np.repeat(np.arange(len(sids)), lengths)
+    order = np.lexsort((rows, slot))
+    rows, slot = rows[order], slot[order]
+
+    frame = {'slot': slot}
+    keep = np.ones(len(rows), dtype=bool)
+    categorical = []
+    for col in columns:
+        keys, is_code = _group_keys(record[col], rows)
+        if is_code:
+            # code -1 is a missing value, which groupby would drop
+            keep &= keys >= 0
+        frame[col] = keys
+        categorical.append(is_code)
+    for measure in measures:
+        frame[measure] = record[measure].to_numpy()[rows]
+    frame = pd.DataFrame(frame)[keep]
+
+    group = frame.groupby(['slot'] + list(columns), sort=True).agg({measure: 'sum' for measure in measures})
+    offsets = np.zeros(len(sids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group.index.get_level_values('slot'), minlength=len(sids)), out=offsets[1:])
+    return {
+        'sids': sids,
+        'offsets': offsets,
+        'keys': [group.index.get_level_values(col).to_numpy() for col in columns],
+        'categorical': categorical,
+        'measures': {measure: group[measure].to_numpy() for measure in measures}
+    }
+
+
+def _write_cube(name, views):
+    # the caller holds cube_lock(name)
+    stamp = _sources(name)
+    path = cube_path(name)
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    metas = []
+    for i, (meta, view) in enumerate(views):
+        np.save(os.path.join(tmp_path, 'v{}_sid.npy'.format(i)), view['sids'])
+        np.save(os.path.join(tmp_path, 'v{}_offsets.npy'.format(i)), view['offsets'])
+        for j, keys in enumerate(view['keys']):
+            np.save(os.path.join(tmp_path, 'v{}_k{}.npy'.format(i, j)), keys)
+        for j, measure in enumerate(meta['measures']):
+            np.save(os.path.join(tmp_path, 'v{}_m{}.npy'.format(i, j)), view['measures'][measure])
+        metas.append(dict(meta, categorical=view['categorical']))
+
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump({'format': [FORMAT_VERSION, columnStore.FORMAT_VERSION], 'source': stamp,
+                   'time_col': TIME_COLUMNS.get(name), 'views': metas}, f)
+    columnStore.publish(tmp_path, path)
+    return path
+
+
+def build_cube(name, insight, record, sid_to_row):
+    with cube_lock(name):
+        return _build_cube(name, insight, record, sid_to_row)
+
+
+def _build_cube(name, insight, record, sid_to_row):
+    views = []
+    for (where, group), wanted in plan_views(insight, TIME_COLUMNS.get(name)).items():
+        columns = [col for col in (where, group) if col is not None]
+        measures = [measure for measure in wanted['measures'] if measure in record.columns and measure not in columns]
+        if any(col not in record.columns for col in columns) or len(measures) == 0:
+            # insights on missing columns keep failing the way they did without a cube
+            continue
+        meta = {'where': where, 'group': group, 'columns': columns, 'measures': measures}
+        views.append((meta, build_view(record, sid_to_row, sorted(wanted['sids']), columns, measures)))
+    return _write_cube(name, views)
+
+
+def _concat_kept(old, kept, fresh):
+    old = np.asarray(old)[kept]
+    return np.concatenate((old, fresh.astype(old.dtype)))
+
+
+def update_cube(name, old_record, record, sid_to_row, changed_sids):
+    # after records were appended: the groups of the changed sids are recomputed from their rows,
+    # the others are kept, with their codes moved onto the record table's grown dictionary
+    with cube_lock(name):
+        if is_fresh(name):
+            # another process already built it from the appended files
+            return cube_path(name)
+        return _update_cube(name, old_record, record, sid_to_row, changed_sids)
+
+
+def _update_cube(name, old_record, record, sid_to_row, changed_sids):
+    cube = load_cube(name, old_record)
+    views = []
+    for meta, view in cube.views():
+        columns, measures = meta['columns'], meta['measures']
+        fresh = build_view(record, sid_to_row, np.intersect1d(view.sids, changed_sids), columns, measures)
+
+        counts = np.diff(view.offsets)
+        slot = np.repeat(np.arange(len(view.sids)), counts)
+        kept = ~np.isin(slot, np.searchsorted(view.sids, fresh['sids']))
+        fresh_slot = np.repeat(np.searchsorted(view.sids, fresh['sids']), np.diff(fresh['offsets']))
+        all_slot = np.concatenate((slot[kept], fresh_slot))
+        order = np.argsort(all_slot, kind='stable')
+
+        keys = []
+        for j, col in enumerate(columns):
+            old_keys = view.keys[j]
+            if view.categories[j] is not None:
+                old_keys = record[col].cat.categories.get_indexer(view.categories[j]).take(old_keys)
+            keys.append(_concat_kept(old_keys, kept, fresh['keys'][j])[order])
+        offsets = np.zeros(len(view.sids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(all_slot, minlength=len(view.sids)), out=offsets[1:])
+        views.append((meta, {
+            'sids': np.asarray(view.sids),
+            'offsets': offsets,
+            'keys': keys,
+            'categorical': fresh['categorical'],
+            'measures': {measure: _concat_kept(view.measures[measure], kept, fresh['measures'][measure])[order]
+                         for measure in measures}
+        }))
+    return _write_cube(name, views)
+
+
+class CubeView():
+    def __init__(self, path, i, meta, record):
+        self.columns = meta['columns']
+        self.sids = np.load(os.path.join(path, 'v{}_sid.npy'.format(i)), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'v{}_offsets.npy'.format(i)), mmap_mode='r')
+        self.keys = [np.load(os.path.join(path, 'v{}_k{}.npy'.format(i, j)), mmap_mode='r')
+                     for j in range(len(self.columns))]
+        # codes index the dataset's feature dictionary, which the record categoricals carry
+        self.categories = [record[col].cat.categories if is_code else None
+                           for col, is_code in zip(self.columns, meta['categorical'])]
+        self.measures = {measure: np.load(os.path.join(path, 'v{}_m{}.npy'.format(i, j)), mmap_mode='r')
+                         for j, measure in enumerate(meta['measures'])}
+
+    def slot_range(self, sid):
+        slot = int(np.searchsorted(self.sids, sid))
+        if slot == len(self.sids) or self.sids[slot] != sid:
+            return None
+        return int(self.offsets[slot]), int(self.offsets[slot + 1])
+
+    def encode(self, j, value):
+        if self.categories[j] is None:
+            return value
+        return self.categories[j].get_indexer([value])[0]
+
+    def decode(self, j, keys):
+        if self.categories[j] is None:
+            return np.array(keys)
+        return pd.Categorical.from_codes(np.array(keys), self.categories[j])
+
+
+class DataCube():
+    # measure sums per (sid, group value), optionally restricted to one value of a where column,
+    # for every combination the dataset's insights refer to
+    def __init__(self, path, record):
+        # path is a version directory (columnStore.resolve), so every file comes from one build
+        meta = _read_meta(path)
+        if meta is None:
+            raise FileNotFoundError(os.path.join(path, META_FILE))
+        self.__meta = meta['views']
+        self.__views = dict()
+        for i, view in enumerate(self.__meta):
+            self.__views[(view['where'], view['group'])] = CubeView(path, i, view, record)
+
+    def views(self):
+        return [(meta, self.__views[(meta['where'], meta['group'])]) for meta in self.__meta]
+
+    def lookup(self, sid, group, measures, where=None, value=None):
+        # the frame groupby(group, as_index=False) would give over the subspace's records
+        # (those with where == value, if given); None when the cube does not hold it
+        view = self.__views.get((where, group))
+        if view is None or any(measure not in view.measures for measure in measures):
+            return None
+        bounds = view.slot_range(sid)
+        if bounds is None:
+            return None
+        rows = np.arange(*bounds)
+        if where is not None:
+            rows = rows[np.asarray(view.keys[0][rows] == view.encode(0, value))]
+        data = {group: view.decode(len(view.columns) - 1, view.keys[-1][rows])}
+        for measure in measures:
+            data[measure] = np.array(view.measures[measure][rows])
+        return pd.DataFrame(data)
+
+
+def load_cube(name, record):
+    # started over on the current version should the one resolved be removed mid-read
+    for attempt in range(columnStore.READ_ATTEMPTS):
+        try:
+            return DataCube(columnStore.resolve(cube_path(name)), record)
+        except FileNotFoundError:
+            if attempt == columnStore.READ_ATTEMPTS - 1:
+                raise
+
+
+def ensure_cube(name, record, sources):
+    # the stored cube, built first unless it is fresh; sources() -> (insight, sid_to_row) is
+    # only called to build it. Whoever waited for the lock finds the cube another process built
+    if not is_fresh(name):
+        with cube_lock(name):
+            if not is_fresh(name):
+                insight, sid_to_row = sources()
+                _build_cube(name, insight, record, sid_to_row)
+    return load_cube(name, record)
+
+
+def build_all(names=None):
+    for file_name in sorted(os.listdir(os.path.join(columnStore.DATA_FOLDER, 'insight'))):
+        name = file_name[len('insight_'):-len('.csv')]
+        if names and name not in names:
+            continue
+        try:
+            if is_fresh(name):
+                continue
+            record = columnStore.load_table('record', name)
+            sid_cid = columnStore.load_table('sid_cid', name)
+        except OSError:
+            continue
+        print('build {}'.format(os.path.relpath(cube_path(name), columnStore.ROOT_PATH)))
+        ensure_cube(name, record, lambda: (columnStore.load_table('insight', name),
+                                           SubspaceIndex(sid_cid, record).sid_to_row))
+
+
+if __name__ == '__main__':
+    build_all(sys.argv[1:])
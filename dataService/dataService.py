@@ -1,74 +1,228 @@
+import base64
 import datetime
 import os
-import pandas as pd
-from flask_caching import Cache
-import seaborn as sns
-from scipy.stats import pearsonr
-
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
 import math
 
-from sklearn.cluster import DBSCAN
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import StandardScaler
+from dataService import analytics, columnStore, dataCube, ingest, jsonStream, kde, sketches
+from dataService.aggregates import CubeAggregator, SubspaceAggregator
+from dataService.analyticsPool import AnalyticsPool
+from dataService.datasetRegistry import Dataset, DatasetRegistry, estimate_nbytes
+from dataService.indexes import CsrIndex, EdgeIndex, SimilarInsightIndex, SubspaceIndex, gather, \
+    merge_ranked_groups, ranked_groups, value_counts
+from dataService.metrics import METRICS
+from dataService.spatialIndex import GridIndex
+from dataService.startup import PROFILE, lazy_import
 
-cache = Cache()
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 FILE_ABS_PATH = os.path.dirname(__file__)
 ROOT_PATH = os.path.join(FILE_ABS_PATH, '../')
-EDGE_FOLDER = os.path.join(ROOT_PATH, 'data/edge')
 INSIGHT_FOLDER = os.path.join(ROOT_PATH, 'data/insight')
-RECORD_FOLDER = os.path.join(ROOT_PATH, 'data/record')
-SID_CID_FOLDER = os.path.join(ROOT_PATH, 'data/sid_cid')
-SUBSPACE_FOLDER = os.path.join(ROOT_PATH, 'data/subspace')
 
-sns_counter = 0
+WARM_UP_WORKERS = int(os.environ.get('V4I_WARM_UP_WORKERS', '2'))
+APPROX_SAMPLE_SIZE = 10000
+APPROX_TOP_VALUES = 100
+# the largest approximate profile a client gets, whatever sample size or error it asks for
+APPROX_MAX_SAMPLE_SIZE = 1 << 20
+APPROX_MAX_TOP_VALUES = 1 << 12
+# edges per page unless the client asks for more, and the most it can ask for
+EDGE_PAGE_SIZE = 1000
+EDGE_MAX_PAGE_SIZE = 10000
+# breakdown values a Top1 insight shows unless the client asks for k
+TOP1_VALUES = 10
+# insight types that rank their breakdown values and honour k
+TOP_K_INSIGHTS = ['Top1', 'Attribution']
+# derived artefacts that do not depend on the record table, kept when records are appended
+INGEST_CARRIED_OVER = ['insight_meta', 'projection', 'edge_index', 'similar_insight_index',
+                       'insight_count_for_subspace']
 
 
 class DataService():
-    def __init__(self):
-        pass
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else DatasetRegistry()
+        self.registry.on_load = self.__warm_up
+        self.analytics = AnalyticsPool()
+        self.warm_up_pool = ThreadPoolExecutor(max_workers=WARM_UP_WORKERS) if WARM_UP_WORKERS > 0 else None
+        self.ready = False
+
+    def preload(self, names=None):
+        # loads and fully warms every dataset in the calling thread, e.g. in a server's master
+        # process before it forks workers, so no pool threads exist yet at fork time
+        for name in names or self.read_data_names():
+            start = time.perf_counter()
+            dataset = self.registry.get(name, notify=False)
+            for kind in columnStore.KINDS:
+                try:
+                    dataset.table(kind)
+                except OSError:
+                    pass
+            loaded = time.perf_counter()
+            PROFILE.record_dataset(name, 'load', loaded - start)
+            self.__warm_up(dataset, wait=True)
+            PROFILE.record_dataset(name, 'warm up', time.perf_counter() - loaded)
+        self.ready = True
+
+    def get_data_versions(self):
+        return {name: self.registry.version(name) for name in self.read_data_names()}
+
+    def append_records(self, name, records):
+        # adds records to a dataset without recomputing it: the new rows join the subspaces whose
+        # patterns they match, the per-record counts and the data cube are updated for them, and
+        # the artefacts that do not depend on the records are carried over to the new version
+        with ingest.dataset_lock(name):
+            dataset = self.registry.get(name)
+            insight_data, _, _ = self.__get_insight_by_name(name)
+            subspace_data, feature_data = self.__get_subspace_by_name(name)
+            record_data = dataset.table('record')
+            sid_cid = dataset.table('sid_cid')
+
+            new_record = ingest.prepare_records(record_data, records)
+            # subspaces without any members in sid_cid are not tracked there and stay so
+            tracked = subspace_data.loc[subspace_data['sid'].isin(np.unique(sid_cid['sid'].to_numpy()))]
+            sid, row = ingest.match_subspaces(tracked, feature_data, new_record)
+            cid = new_record['cid'].to_numpy()[row]
+            new_sid_cid = pd.DataFrame({'sid': sid, 'cid': cid})[list(sid_cid.columns)]
+
+            stored = {kind: columnStore.is_fresh(kind, name) for kind in ['sid_cid', 'record']}
+            cube_fresh = dataCube.is_fresh(name)
+            # memberships go first: those whose record is not there yet are ignored by readers
+            for kind, df in [('sid_cid', new_sid_cid), ('record', new_record)]:
+                ingest.append_csv(kind, name, df)
+                if stored[kind]:
+                    columnStore.append_table(kind, name, df)
+
+            updated = Dataset(self.registry, name, self.registry.version(name))
+            updated.put_table('insight', insight_data)
+            for key, value in dataset.cached_items():
+                if key in INGEST_CARRIED_OVER or key.startswith('spatial:'):
+                    updated.put_derived(key, value)
+            record = updated.table('record')
+            subspace_index = SubspaceIndex(updated.table('sid_cid'), record)
+            updated.put_derived('subspace_index', subspace_index)
+
+            counts = dataset.cached('insight_count_for_record')
+            if counts is not None:
+                keys = ['cid', 'iid_count', 'offsets', 'iids']
+                updated.put_derived('insight_count_for_record', dict(zip(keys, merge_ranked_groups(
+                    [counts[key] for key in keys], self.__count_insight_for_memberships(insight_data, sid, cid)))))
+            counts = dataset.cached('subspace_count_for_record')
+            if counts is not None:
+                keys = ['cid', 'sid_count', 'offsets', 'sid']
+                updated.put_derived('subspace_count_for_record', dict(zip(keys, merge_ranked_groups(
+                    [counts[key] for key in keys], ranked_groups(cid, sid)))))
+
+            if cube_fresh:
+                dataCube.update_cube(name, record_data, record, subspace_index.sid_to_row, np.unique(sid))
+                updated.put_derived('data_cube', dataCube.load_cube(name, record))
+
+            payloads = dataset.cached('insight_payload')
+            if payloads is not None:
+                changed = set(insight_data['iid'].to_numpy()[np.isin(insight_data['sid'].to_numpy(), sid)].tolist())
+                updated.put_derived('insight_payload', {
+                    iid: payload for iid, payload in list(payloads.items()) if iid not in changed})
+
+            # the warm-up renders the changed insights and rebuilds the data info
+            self.registry.publish(updated)
+        return {
+            'cid': new_record['cid'].tolist(),
+            'subspace_count': len(np.unique(sid)),
+            'membership_count': len(sid)
+        }
+
+    def __warm_up(self, dataset, wait=False):
+        name = dataset.name
+        try:
+            self.get_data_info_by_name(name)
+            self.__get_insight_count_for_record(name)
+            self.__get_subspace_count_for_record(name)
+            self.__get_insight_count_for_subspace(name)
+            self.__get_data_cube(name)
+            insight_data, _, _ = self.__get_insight_by_name(name)
+            for projection in ['xy'] + list(self.__get_projection_by_name(name)):
+                self.__get_spatial_index(name, projection)
+        except (OSError, KeyError):
+            # incomplete datasets only fail once an endpoint actually needs the missing table
+            return
+        # render the most relevant insights first
+        iids = insight_data.sort_values(by='score', ascending=False, kind='stable')['iid'].tolist()
+        if wait:
+            for iid in iids:
+                self.__warm_up_insight(dataset, iid)
+            return
+        if self.warm_up_pool is None:
+            return
+        try:
+            for iid in iids:
+                self.warm_up_pool.submit(self.__warm_up_insight, dataset, iid)
+        except RuntimeError:
+            # the pool refuses new work once the interpreter is shutting down
+            pass
+
+    def __warm_up_insight(self, dataset, iid):
+        payloads = dataset.derived('insight_payload', dict)
+        if iid in payloads or not self.registry.is_current(dataset):
+            return
+        try:
+            with self.analytics.inline(), METRICS.span('render'):
+                payload = self.__render_insight(iid, dataset.name)
+            self.__store_insight_payload(dataset, iid, payload)
+        except Exception:
+            # insights that cannot be rendered fail again on demand and report the error there
+            pass
+
+    def __store_insight_payload(self, dataset, iid, payload):
+        dataset.derived('insight_payload', dict)[iid] = payload
+        dataset.account(estimate_nbytes(payload))
 
     def read_data_names(self):
         return [p.split('.')[0].split('_')[-1] for p in os.listdir(INSIGHT_FOLDER)]
 
-    @cache.memoize(timeout=50)
     def __get_edge_by_name(self, name):
-        edges_path = os.path.join(EDGE_FOLDER, 'edge_{}.csv'.format(name))
-        df = pd.read_csv(edges_path)
-        return df
+        return self.registry.get(name).table('edge')
 
-    @cache.memoize(timeout=50)
     def __get_insight_by_name(self, name):
-        insight_path = os.path.join(INSIGHT_FOLDER, 'insight_{}.csv'.format(name))
-        df = pd.read_csv(insight_path)
-        return df, df['insight'].unique().tolist(), df['insight_type'].unique().tolist()
+        dataset = self.registry.get(name)
+        df = dataset.table('insight')
+        return dataset.derived('insight_meta', lambda: (
+            df, df['insight'].unique().tolist(), df['insight_type'].unique().tolist()))
 
-    @cache.memoize(timeout=50)
     def __get_record_by_name(self, name):
-        record_path = os.path.join(RECORD_FOLDER, 'record_{}.csv'.format(name))
-        df = pd.read_csv(record_path)
-        return df
+        return self.registry.get(name).table('record')
 
-    @cache.memoize(timeout=50)
     def __get_sid_cid_by_name(self, name):
-        sid_cid_path = os.path.join(SID_CID_FOLDER, 'sid_cid_{}.csv'.format(name))
-        df = pd.read_csv(sid_cid_path)
-        return df
+        return self.registry.get(name).table('sid_cid')
 
-    @cache.memoize(timeout=50)
     def __get_subspace_by_name(self, name):
-        subspace_path = os.path.join(SUBSPACE_FOLDER, 'subspace_{}.csv'.format(name))
-        df = pd.read_csv(subspace_path)
+        df = self.registry.get(name).table('subspace')
         return df, df.columns.values.tolist()[0:-1]
 
+    def __get_projection_by_name(self, name):
+        return self.registry.get(name).derived('projection', lambda: columnStore.load_projections(name))
+
+    def __get_subspace_index(self, name):
+        return self.registry.get(name).derived('subspace_index', lambda: SubspaceIndex(
+            self.__get_sid_cid_by_name(name), self.__get_record_by_name(name)))
+
+    def __get_data_cube(self, name):
+        def sources():
+            insight_data, _, _ = self.__get_insight_by_name(name)
+            return insight_data, self.__get_subspace_index(name).sid_to_row
+        return self.registry.get(name).derived('data_cube', lambda: dataCube.ensure_cube(
+            name, self.__get_record_by_name(name), sources))
+
+    def __get_subspace_aggregator(self, name, sid, measures_by_breakdown=None):
+        return CubeAggregator(self.__get_data_cube(name), sid, lambda: SubspaceAggregator(
+            self.__get_record_by_subspace(name, sid), measures_by_breakdown))
+
     def __get_record_by_subspace(self, name, sid):
-        sid_cid_data = self.__get_sid_cid_by_name(name)
         record_data = self.__get_record_by_name(name)
+        rows = self.__get_subspace_index(name).rows_of_sid(sid)
 
-        df = pd.merge(sid_cid_data, record_data, on=['cid'])
-        df = df.loc[df['sid'] == sid]
-        df = df.drop(['sid', 'cid'], axis=1)
+        df = record_data.iloc[rows]
+        df = df.drop(['cid'], axis=1)
         return df
 
     def __get_subspace_str(self, subspace_col, row):
@@ -84,7 +238,17 @@ class DataService():
             subspace = subspace[0:-2]
         return subspace
 
-    def get_data_by_name(self, name):
+    def get_data_by_name(self, name, projection=None):
+        res = dict()
+        for key, value in self.__get_data_sections(name, projection):
+            res[key] = value.to_python() if isinstance(value, jsonStream.Records) else value
+        return res
+
+    def iter_data_by_name(self, name, projection=None):
+        # the same payload as get_data_by_name, written out section by section as JSON text
+        return jsonStream.iter_object(self.__get_data_sections(name, projection))
+
+    def __get_data_sections(self, name, projection=None):
         edge_data = self.__get_edge_by_name(name)
         insight_data, insight_name, insight_type = self.__get_insight_by_name(name)
         measure_col = insight_data['measure'].unique()
@@ -97,37 +261,189 @@ class DataService():
         # record_data = self.__get_record_by_name(name)
         subspace_data, feature_data = self.__get_subspace_by_name(name)
         insight_cnt = insight_data['insight'].value_counts().to_dict()
+        insight_record = insight_data
+        if projection is not None:
+            # the client renders a single packed projection instead of the string columns
+            insight_record = insight_data.drop(
+                columns=[col for col in columnStore.PROJECTION_COLUMNS if col in insight_data.columns])
+        sections = [
+            # ('record', jsonStream.Records(record_data)),
+            ('insight', jsonStream.Records(insight_record)),
+            ('edge', jsonStream.Records(edge_data)),
+            ('feature', feature_data),
+            ('insight_name', insight_name),
+            ('insight_count', [insight_cnt[x] for x in insight_name]),
+            ('insight_type', insight_type),
+            ('subspace', jsonStream.IndexedRecords(subspace_data)),
+            ('measures', measures)
+        ]
+        if projection is not None:
+            sections.append(('projection', self.get_projection_by_name(name, projection)))
+        return sections
+
+    def __get_edge_index(self, name):
+        return self.registry.get(name).derived('edge_index', lambda: EdgeIndex(self.__get_edge_by_name(name)))
+
+    def __get_coordinates(self, name, projection):
+        # 'xy' is the layout in the insight table's own x/y columns
+        if projection == 'xy':
+            insight_data, _, _ = self.__get_insight_by_name(name)
+            return insight_data[['x', 'y']].to_numpy(dtype=np.float64)
+        return self.__get_projection_by_name(name)[projection]
+
+    def __get_spatial_index(self, name, projection):
+        return self.registry.get(name).derived(
+            'spatial:' + projection, lambda: GridIndex(self.__get_coordinates(name, projection)))
+
+    def __get_iids_in_box(self, name, bbox, projection):
+        insight_data, _, _ = self.__get_insight_by_name(name)
+        rows = self.__get_spatial_index(name, projection).range(*bbox)
+        return insight_data['iid'].to_numpy()[rows]
+
+    def __get_insight_points(self, name, projection, rows):
+        insight_data, _, _ = self.__get_insight_by_name(name)
+        coords = self.__get_coordinates(name, projection)[rows]
+        return {
+            'iid': insight_data['iid'].to_numpy()[rows].tolist(),
+            'insight': insight_data['insight'].to_numpy()[rows].tolist(),
+            'score': insight_data['score'].to_numpy()[rows].tolist(),
+            'x': coords[:, 0].tolist(),
+            'y': coords[:, 1].tolist()
+        }
+
+    def get_insights_in_range(self, name, bbox, projection='xy'):
+        rows = self.__get_spatial_index(name, projection).range(*bbox)
+        return self.__get_insight_points(name, projection, rows)
+
+    def get_nearest_insights(self, name, point, k, projection='xy'):
+        rows, distance = self.__get_spatial_index(name, projection).nearest(point[0], point[1], k)
+        res = self.__get_insight_points(name, projection, rows)
+        res['distance'] = distance.tolist()
+        return res
+
+    def get_edges_by_name(self, name, min_jaccard=0., iids=None, bbox=None, projection='xy', mode='any',
+                          cursor=0, page_size=EDGE_PAGE_SIZE):
+        index = self.__get_edge_index(name)
+        nodes = None
+        if iids is not None:
+            nodes = np.asarray(iids, dtype=np.int64)
+        if bbox is not None:
+            in_box = self.__get_iids_in_box(name, bbox, projection)
+            nodes = in_box if nodes is None else np.intersect1d(nodes, in_box)
+        ranks = index.query(min_jaccard, nodes, mode)
+        page = ranks[cursor:cursor + page_size]
         return {
-            # 'record': record_data.to_dict('records'),
-            'insight': insight_data.to_dict('records'),
-            'edge': edge_data.to_dict('records'),
-            'feature': feature_data,
-            'insight_name': insight_name,
-            'insight_count': [insight_cnt[x] for x in insight_name],
-            'insight_type': insight_type,
-            'subspace': subspace_data.to_dict('index'),
-            'measures': measures
+            'source': index.source[page].tolist(),
+            'target': index.target[page].tolist(),
+            'jaccard_index': index.jaccard[page].tolist(),
+            'total': len(ranks),
+            'next_cursor': cursor + len(page) if cursor + len(page) < len(ranks) else None
         }
 
+    def get_projection_by_name(self, name, projection):
+        insight_data, _, _ = self.__get_insight_by_name(name)
+        coords = self.__get_projection_by_name(name)[projection]
+        iid = insight_data['iid'].to_numpy().astype('<i4')
+        # little-endian int32 iids and float32 (x, y) pairs, row-aligned with the insight table
+        return {
+            'projection': projection,
+            'count': coords.shape[0],
+            'iid': base64.b64encode(iid.tobytes()).decode('ascii'),
+            'coords': base64.b64encode(np.ascontiguousarray(coords, dtype='<f4').tobytes()).decode('ascii')
+        }
+
+    def __get_insight_count_for_record(self, name):
+        return self.registry.get(name).derived('insight_count_for_record', lambda: self.__count_insight_for_record(name))
+
+    def __count_insight_for_record(self, name):
+        insight_data, _, _ = self.__get_insight_by_name(name)
+        sid_to_cid = self.__get_subspace_index(name).sid_to_cid
+        cids, lengths = gather(sid_to_cid, insight_data['sid'].to_numpy())
+        iids = np.repeat(insight_data['iid'].to_numpy(), lengths)
+        cid, iid_count, offsets, iids = ranked_groups(cids, iids)
+        return {'cid': cid, 'iid_count': iid_count, 'offsets': offsets, 'iids': iids}
+
+    def __count_insight_for_memberships(self, insight_data, sid, cid):
+        # the ranked groups __count_insight_for_record gives for the records of new memberships;
+        # a record's insights keep the order of the insight table
+        by_sid = CsrIndex(insight_data['sid'].to_numpy(), np.arange(len(insight_data)))
+        rows, lengths = gather(by_sid, sid)
+        cids = np.repeat(cid, lengths)
+        order = np.lexsort((rows, cids))
+        return ranked_groups(cids[order], insight_data['iid'].to_numpy()[rows[order]])
+
     def get_insight_count_for_record_by_name(self, name):
-        sid_cid_df = self.__get_sid_cid_by_name(name)
+        res = self.__get_insight_count_for_record(name)
+        return {key: value.tolist() for key, value in res.items()}
+
+    def get_insight_by_iid(self, iid, name, k=None):
+        # k caps the breakdown values of ranking insights; those payloads are not cached
+        dataset = self.registry.get(name)
+        payload = dataset.derived('insight_payload', dict).get(iid)
+        if payload is None or (k is not None and self.__takes_top_k(payload)):
+            with METRICS.span('render'):
+                payload = self.__render_insight(iid, name, k=k)
+            if k is None or not self.__takes_top_k(payload):
+                self.__store_insight_payload(dataset, iid, payload)
+        return payload
+
+    def __takes_top_k(self, payload):
+        return isinstance(payload, dict) and payload.get('insight_name') in TOP_K_INSIGHTS
+
+    def iter_insight_by_iids(self, iids, name, k=None):
+        # yields (iid, payload, error) as each insight is ready: cached payloads first, then one
+        # subspace at a time so its records are sliced and grouped once for all of its insights
+        dataset = self.registry.get(name)
+        payloads = dataset.derived('insight_payload', dict)
         insight_data, _, _ = self.__get_insight_by_name(name)
-        iids_df = pd.merge(insight_data, sid_cid_df, on='sid', how='inner')
-        iids_df = iids_df.groupby('cid')['iid'].apply(list).reset_index(name='iids')
-        iids_df['iid_count'] = [len(id_list) for id_list in iids_df['iids']]
-        iids_df.sort_values(by='iid_count', inplace=True, ascending=False)
-        iids_df.reset_index(inplace=True, drop=True)
-        res = iids_df.to_dict('index')
-        return res
 
-    def get_insight_by_iid(self, iid, name):
+        missing = []
+        for iid in dict.fromkeys(iids):
+            payload = payloads.get(iid)
+            if payload is not None and (k is None or not self.__takes_top_k(payload)):
+                yield iid, payload, None
+            else:
+                missing.append(iid)
+        if len(missing) == 0:
+            return
+
+        insight = insight_data.loc[insight_data['iid'].isin(missing)]
+        for iid in set(missing) - set(insight['iid'].tolist()):
+            yield iid, None, 'unknown iid {}'.format(iid)
+        for sid, group in insight.groupby('sid', sort=False):
+            measures_by_breakdown = dict()
+            for breakdown, measure in zip(group['breakdown'], group['measure']):
+                wanted = measures_by_breakdown.setdefault(breakdown, [])
+                wanted.extend(m for m in measure.split(';') if m not in wanted)
+            aggregator = self.__get_subspace_aggregator(name, sid, measures_by_breakdown)
+            for iid in group['iid'].tolist():
+                try:
+                    with METRICS.span('render'):
+                        payload = self.__render_insight(iid, name, aggregator, k)
+                except Exception as e:
+                    yield iid, None, repr(e)
+                    continue
+                if k is None or not self.__takes_top_k(payload):
+                    self.__store_insight_payload(dataset, iid, payload)
+                yield iid, payload, None
+
+    def get_insight_by_iids(self, iids, name, k=None):
+        results = dict()
+        for iid, payload, error in self.iter_insight_by_iids(iids, name, k):
+            results[iid] = {'iid': iid, 'data': payload} if error is None else {'iid': iid, 'error': error}
+        return [results[iid] for iid in iids]
+
+    def __render_insight(self, iid, name, aggregator=None, k=None):
         insight_data, insight_name, insight_type = self.__get_insight_by_name(name)
         subspace_data, feature_data = self.__get_subspace_by_name(name)
         insight = insight_data.loc[insight_data['iid'] == iid]
-        insight = pd.merge(insight, subspace_data, on='sid', how='inner')
-        record = self.__get_record_by_subspace(name, insight['sid'].iloc[0])
+        with METRICS.span('merge'):
+            insight = pd.merge(insight, subspace_data, on='sid', how='inner')
+        if aggregator is None:
+            aggregator = self.__get_subspace_aggregator(name, insight['sid'].iloc[0])
 
         insight_name = insight['insight'].iloc[0]
+        METRICS.annotate(insight=insight_name)
         breakdown = insight['breakdown'].iloc[0]
         breakdown_value = insight['breakdown_value'].iloc[0]
         if breakdown_value.isdigit():
@@ -136,8 +452,8 @@ class DataService():
         subspace = self.__get_subspace_str(feature_data, insight)
 
         if insight_name == 'Top1':
-            record = record.groupby(breakdown, as_index=False).agg({measure: 'sum'})
-            record = record.sort_values(by=measure, ascending=False).iloc[0:10]
+            record = aggregator.aggregate(breakdown, [measure])
+            record = record.iloc[analytics.top_k(record[measure].to_numpy(), k or TOP1_VALUES)]
             measure_value = record[measure].tolist()
             sentence = '<span style="display:inline;">The highest {} among {} is {} with {} ' \
                        'equals <span style="color:#f7cd59; display:inline;">{}</span> {}.</span>' \
@@ -153,8 +469,7 @@ class DataService():
                 'sentence': sentence
             }
         elif insight_name == 'Trend':
-            record = record.groupby(breakdown, as_index=False).agg(
-                {breakdown: 'first', measure: 'sum'})
+            record = aggregator.aggregate(breakdown, [measure])
 
             breakdown_value = record[breakdown]
 
@@ -165,10 +480,7 @@ class DataService():
             except:
                 x = record[breakdown].values
 
-            x = np.array(x).reshape(-1, 1)
-            y = np.array(record[measure]).reshape(-1, 1)
-            reg = LinearRegression().fit(x, y)
-            slope = reg.coef_[0][0]
+            slope = self.analytics.run(analytics.linear_slope, np.array(x), np.array(record[measure]))
             sentence = '<span style="display:inline;">The sum of {} over {} is ' \
                        '<span style="color:#f7cd59; display:inline;">{}</span> {}.</span>' \
                 .format(measure, breakdown,
@@ -189,39 +501,15 @@ class DataService():
                 'sentence': sentence
             }
         elif insight_name == 'Correlation':
-            time_col = ""
-            if name == 'carSales1':
-                time_col = 'Year'
-            elif name == 'Emission':
-                time_col = 'Year'
-            elif name == 'Census':
-                time_col = 'Birthday'
-            elif name == 'NBA':
-                time_col = 'year'
+            time_col = dataCube.TIME_COLUMNS.get(name, "")
 
             breakdown_value = insight['breakdown_value'].values[0].split(';')
-            _, col_list = self.__get_subspace_by_name(name)
-            record = self.__get_record_by_name(name)
-            record.drop(['cid'], axis=1, inplace=True)
-
-            for i in range(len(col_list)):
-                value = insight[col_list[i]].values[0]
-                if value != '*':
-                    record = record.loc[record[col_list[i]] == value]
-            if breakdown_value[1] != '*':
-                corr_record = record.loc[record[insight['breakdown'].values[0]] == breakdown_value[1]]
-            else:
-                corr_record = record.copy()
-            if breakdown_value[0] != '*':
-                record = record.loc[record[insight['breakdown'].values[0]] == breakdown_value[0]]
-
-            corr_record = corr_record.groupby(time_col, as_index=False).agg(
-                {breakdown: 'first', measure: 'sum'})
-            record = record.groupby(time_col, as_index=False).agg(
-                {breakdown: 'first', measure: 'sum'})
+            sid = insight['sid'].iloc[0]
+            record = self.__get_time_series(name, sid, breakdown, breakdown_value[0], time_col, measure)
+            corr_record = self.__get_time_series(name, sid, breakdown, breakdown_value[1], time_col, measure)
             y1 = record[measure].values
             y2 = corr_record[measure].values
-            corr, _ = pearsonr(y1, y2)
+            corr = self.analytics.run(analytics.pearson, y1, y2)
 
             sentence = '<span style="display:inline;">The {} of ' \
                        '<span style="color:#f7cd59; display:inline;">{}</span> and ' \
@@ -243,8 +531,7 @@ class DataService():
                 'sentence': sentence
             }
         elif insight_name == 'Change Point' or insight_name == 'Outlier':
-            record = record.groupby(breakdown, as_index=False).agg(
-                {breakdown: 'first', measure: 'sum'})
+            record = aggregator.aggregate(breakdown, [measure])
             # todo: int value might be read as string
             y = record.loc[record[breakdown] == breakdown_value][measure].iloc[0]
 
@@ -275,28 +562,23 @@ class DataService():
                 'sentence': sentence
             }
         elif insight_name == 'Attribution':
-            record = record.groupby(breakdown, as_index=False).agg(
-                {breakdown: 'first', measure: 'sum'})
-            record = record.sort_values(by=measure, ascending=False)
+            record = aggregator.aggregate(breakdown, [measure])
+            values = record[measure].to_numpy()
+            order = analytics.top_k(values, k)
+            # shares of the whole breakdown, summed in rank order when every value is kept
+            total = np.nansum(values[order] if k is None else values)
+            record = record.iloc[order]
 
             breakdown_value = record[breakdown].tolist()
-            percentage = (record[measure] / record[measure].sum()).tolist()
+            percentage = [round(p, 2) for p in (record[measure] / total).tolist()]
 
             breakdown_value_list = ''
             percentage_list = ''
-            for i in range(len(breakdown_value)):
-                percentage[i] = round(percentage[i], 2)
-                if i == 0:
-                    breakdown_value_list += '<span style="color:#f7cd59; display:inline;">' \
-                                            + breakdown_value[i] + '</span>, '
-                    percentage_list += '<span style="color:#f7cd59; display:inline;">' \
-                                       + str(percentage[i]) + '</span>, '
-                else:
-                    breakdown_value_list += breakdown_value[i] + ', '
-                    percentage_list += str(percentage[i]) + ', '
-            if breakdown_value_list[-2:] == ', ':
-                breakdown_value_list = breakdown_value_list[0:-2]
-                percentage_list = percentage_list[0:-2]
+            if len(breakdown_value) > 0:
+                breakdown_value_list = ', '.join(['<span style="color:#f7cd59; display:inline;">'
+                                                  + breakdown_value[0] + '</span>'] + breakdown_value[1:])
+                percentage_list = ', '.join(['<span style="color:#f7cd59; display:inline;">'
+                                             + str(percentage[0]) + '</span>'] + [str(p) for p in percentage[1:]])
             sentence = '<span style="display:inline;">{} makes up {} ' \
                        'of the {} {}{}{}{}.</span>' \
                 .format(' and '.join(breakdown_value_list.rsplit(', ', 1)),
@@ -315,13 +597,12 @@ class DataService():
             }
         elif insight_name == 'Cross Measure Correlation':
             measures = measure.split(';')
-            record = record.groupby(breakdown, as_index=False).agg(
-                {breakdown: 'first', measures[0]: 'sum', measures[1]: 'sum'})
+            record = aggregator.aggregate(breakdown, measures[0:2])
             record = record.sort_values(by=measures[0])
 
             x_value = record[measures[0]].values
             y_value = record[measures[1]].values
-            reg = LinearRegression().fit(x_value.reshape(-1, 1), y_value.reshape(-1, 1))
+            line_y_value = self.analytics.run(analytics.line_endpoints, x_value, y_value)
 
             sentence = '<span style="display:inline;">' \
                        '<span style="color:#f7cd59; display:inline;">{}</span> and ' \
@@ -337,24 +618,17 @@ class DataService():
                 'insight_name': insight_name,
                 'x_value': x_value.tolist(),
                 'y_value': y_value.tolist(),
-                'line_y_value': [reg.predict(x_value[0].reshape(-1, 1))[0][0],
-                                 reg.predict(x_value[-1].reshape(-1, 1))[0][0]],
+                'line_y_value': line_y_value,
                 'sentence': sentence
             }
         elif insight_name == 'Clustering':
             measures = measure.split(';')
-            record = record.groupby(breakdown, as_index=False).agg(
-                {breakdown: 'first', measures[0]: 'sum', measures[1]: 'sum'})
+            record = aggregator.aggregate(breakdown, measures[0:2])
             record = record.sort_values(by=measures[0])
 
             x_value = record[measures[0]].values
             y_value = record[measures[1]].values
-            X = np.vstack((x_value, y_value)).T
-            X_scale = StandardScaler().fit_transform(X)
-            db = DBSCAN(eps=0.3, min_samples=5).fit(X_scale)
-            core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-            core_samples_mask[db.core_sample_indices_] = True
-            labels = db.labels_
+            labels = self.analytics.run(analytics.dbscan_labels, x_value, y_value)
 
             noise = ''
             if -1 in labels:
@@ -388,34 +662,101 @@ class DataService():
         else:
             return 0
 
-    def get_insight_count_for_subspace_by_name(self, name):
+    def __get_time_series(self, name, sid, breakdown, value, time_col, measure):
+        # sums of a measure over time within a subspace, restricted to breakdown == value
+        # unless the value is '*'
+        where = (breakdown, value) if value != '*' else (None, None)
+        with METRICS.span('aggregate'):
+            group = self.__get_data_cube(name).lookup(sid, time_col, [measure], *where)
+            if group is None:
+                record = self.__get_record_by_subspace(name, sid)
+                if value != '*':
+                    record = record.loc[record[breakdown] == value]
+                group = record.groupby(time_col, as_index=False, observed=True).agg({measure: 'sum'})
+        return group
+
+    def __get_insight_count_for_subspace(self, name):
+        return self.registry.get(name).derived(
+            'insight_count_for_subspace', lambda: self.__count_insight_for_subspace(name))
+
+    def __count_insight_for_subspace(self, name):
         insight_data, _, _ = self.__get_insight_by_name(name)
-        iid_sid_df = insight_data[['iid', 'sid']].groupby('sid')['iid'].apply(list).reset_index(name='iids')
-        iid_sid_df['iid_count'] = [len(id_list) for id_list in iid_sid_df['iids']]
-        subspace_data, _ = self.__get_subspace_by_name(name)
-        iid_sid_df = pd.merge(iid_sid_df, subspace_data, on='sid', how='inner')
-        iid_sid_df.sort_values(by=['iid_count'], inplace=True, ascending=False)
-        iid_sid_df.reset_index(inplace=True, drop=True)
-        res = iid_sid_df.to_dict('index')
-        return res
+        subspace_data, feature_data = self.__get_subspace_by_name(name)
+        sid_index = pd.Index(subspace_data['sid'].to_numpy())
+        # only subspaces present in the subspace table are reported
+        keep = sid_index.get_indexer(insight_data['sid'].to_numpy()) >= 0
+        sid, iid_count, offsets, iids = ranked_groups(
+            insight_data['sid'].to_numpy()[keep], insight_data['iid'].to_numpy()[keep])
+        rows = sid_index.get_indexer(sid)
+        return {
+            'sid': sid,
+            'iid_count': iid_count,
+            'offsets': offsets,
+            'iids': iids,
+            'subspace': {feature: subspace_data[feature].to_numpy()[rows] for feature in feature_data}
+        }
 
-    def get_subspace_count_for_record_by_name(self, name):
-        sid_cid_df = self.__get_sid_cid_by_name(name)
-        record_data = self.__get_record_by_name(name)
-        df = pd.merge(record_data, sid_cid_df, on='cid', how='inner')
-        df = df.groupby('cid')['sid'].apply(list).reset_index(name='sid')
-        df['sid_count'] = [len(id_list) for id_list in df['sid']]
-        df.sort_values(by='sid_count', inplace=True, ascending=False)
-        df.reset_index(inplace=True, drop=True)
-        res = df.to_dict('index')
-        return res
+    def get_insight_count_for_subspace_by_name(self, name):
+        res = self.__get_insight_count_for_subspace(name)
+        data = {key: value.tolist() for key, value in res.items() if key != 'subspace'}
+        data['subspace'] = {key: value.tolist() for key, value in res['subspace'].items()}
+        return data
+
+    def __get_subspace_count_for_record(self, name):
+        return self.registry.get(name).derived(
+            'subspace_count_for_record', lambda: self.__count_subspace_for_record(name))
+
+    def __count_subspace_for_record(self, name):
+        cid_to_sid = self.__get_subspace_index(name).cid_to_sid
+        counts = cid_to_sid.counts()
+        cids = np.repeat(np.arange(len(cid_to_sid)), counts)
+        cid, sid_count, offsets, sids = ranked_groups(cids, cid_to_sid.values)
+        return {'cid': cid, 'sid_count': sid_count, 'offsets': offsets, 'sid': sids}
 
-    @cache.memoize(timeout=50)
-    def get_data_info_by_name(self, name):
-        global sns_counter
+    def get_subspace_count_for_record_by_name(self, name):
+        res = self.__get_subspace_count_for_record(name)
+        return {key: value.tolist() for key, value in res.items()}
+
+    def get_data_info_by_name(self, name, approximate=False, sample_size=None, error=None):
+        if not approximate:
+            return self.registry.get(name).derived('data_info', lambda: self.__build_data_info(name))
+        if sample_size is None:
+            sample_size = sketches.sample_size_for_error(error) if error else APPROX_SAMPLE_SIZE
+        top_values = int(math.ceil(1 / error)) if error else APPROX_TOP_VALUES
+        # requested sizes are rounded up to a power of two, so few profiles are cached per dataset
+        if sample_size != APPROX_SAMPLE_SIZE:
+            sample_size = min(1 << (sample_size - 1).bit_length(), APPROX_MAX_SAMPLE_SIZE)
+        if top_values != APPROX_TOP_VALUES:
+            top_values = min(1 << (top_values - 1).bit_length(), APPROX_MAX_TOP_VALUES)
+        return self.registry.get(name).derived(
+            'data_info_approx:{}:{}'.format(sample_size, top_values),
+            lambda: self.__build_data_info(name, sample_size, top_values))
+
+    def __get_column_density(self, name, col):
+        def build():
+            values = self.__get_record_by_name(name)[col].to_numpy()
+            with METRICS.span('kde'):
+                x, y = kde.gaussian_kde_grid(values)
+            return x.tolist(), y.tolist()
+        return self.registry.get(name).derived('density:' + col, build)
+
+    def __sample_column_density(self, values):
+        with METRICS.span('kde'):
+            x, y = kde.gaussian_kde_grid(values, binned=True)
+        return x.tolist(), y.tolist()
+
+    def __sample_value_counts(self, values, n, top_values):
+        counts = value_counts(values).iloc[0:top_values]
+        return pd.Series(sketches.estimate_counts(counts.to_numpy(), len(values), n), index=counts.index)
+
+    def __build_data_info(self, name, sample_size=None, top_values=None):
+        # with a sample size the densities and the counts of the top categorical values come
+        # from one uniform sample of the rows, so the profile is approximate
         record_data = self.__get_record_by_name(name)
         insight_data, _, _ = self.__get_insight_by_name(name)
         record_data = record_data.drop(columns=['cid'])
+        if sample_size is not None:
+            sample = record_data.iloc[sketches.sample_rows(record_data.shape[0], sample_size)]
 
         data_info = {
             'dataName': name,
@@ -425,10 +766,16 @@ class DataService():
             'colName': [],
             'colType': [],
             'colValueType': [],
-            'colValue': []
+            'colValue': [],
+            'approximate': sample_size is not None
         }
+        if sample_size is not None:
+            data_info['sampleSize'] = sample.shape[0]
+            data_info['topValues'] = top_values
 
         for value_type in record_data.dtypes.tolist():
+            if isinstance(value_type, pd.CategoricalDtype):
+                value_type = value_type.categories.dtype
             value_type = str(value_type)
             if value_type != 'int64' and value_type != 'float64':
                 data_info['colValueType'].append('categorical')
@@ -463,23 +810,29 @@ class DataService():
 
             if data_info['colValueType'][i] == 'int' \
                     or data_info['colValueType'][i] == 'float':
-                p = sns.kdeplot(record_data[col].values)
-                lines = [obj for obj in p.findobj() if str(type(obj)) == "<class 'matplotlib.lines.Line2D'>"]
-                x, y = lines[sns_counter].get_data()[0].tolist(), lines[sns_counter].get_data()[1].tolist()
+                if sample_size is None:
+                    x, y = self.__get_column_density(name, col)
+                else:
+                    x, y = self.__sample_column_density(sample[col].to_numpy())
                 data_info['colValue'].append([x, y,
                                               round(min(x), 2), round(max(x), 2),
                                               min(y), max(y)])
-                sns_counter += 1
             else:
-                cnt_dict = record_data[col].value_counts().to_dict()
-                value_list = list(cnt_dict.values())
+                if sample_size is None:
+                    cnt_dict = value_counts(record_data[col]).to_dict()
+                else:
+                    cnt_dict = self.__sample_value_counts(sample[col], record_data.shape[0], top_values).to_dict()
+                key_list, value_list = list(cnt_dict), list(cnt_dict.values())
                 upper_bound = value_list[0]
                 while upper_bound % 5 != 0 or upper_bound % 2 != 0:
                     upper_bound += 1
-                data_info['colValue'].append([list(cnt_dict), value_list, upper_bound])
+                data_info['colValue'].append([key_list, value_list, upper_bound])
 
         return data_info
 
+    def get_cache_stats(self):
+        return self.registry.stats()
+
     def get_data_attr_map_by_name(self, name):
         record_data = self.__get_record_by_name(name)
         _, feature_data = self.__get_subspace_by_name(name)
@@ -507,7 +860,7 @@ class DataService():
         _, feature_data = self.__get_subspace_by_name(name)
         result = {}
         for feature in feature_data:
-            value_count = record_data[feature].value_counts().sort_values(ascending=False)
+            value_count = value_counts(record_data[feature]).sort_values(ascending=False)
             value_angle = (value_count / value_count.sum() * 2 * math.pi).tolist()
             start_angle = np.concatenate(([0.0], np.cumsum(value_angle)))
             end_angle = np.cumsum(value_angle)
@@ -516,13 +869,17 @@ class DataService():
         # feature_cid_count = {feature: record_data[feature].value_counts().to_dict() for feature in feature_data}
         return result
 
+    def __get_similar_insight_index(self, name):
+        def build():
+            insight_data, _, _ = self.__get_insight_by_name(name)
+            subspace_data, feature_data = self.__get_subspace_by_name(name)
+            return SimilarInsightIndex(insight_data, subspace_data, feature_data)
+        return self.registry.get(name).derived('similar_insight_index', build)
+
     def get_similar_insight(self, feature, sid, name, breakdown, breakdown_value):
-        insight_data, insight_name, insight_type = self.__get_insight_by_name(name)
-        subspace_data, feature_data = self.__get_subspace_by_name(name)
-        subspace_data = pd.merge(subspace_data, insight_data, on='sid', how='inner')
+        index = self.__get_similar_insight_index(name)
 
-        subspace = subspace_data.loc[subspace_data['sid'] == sid]
-        feature_value = subspace[feature].tolist()[0]
+        feature_value = index.feature_value(sid, feature)
         if feature_value == '*':
             if breakdown == feature:
                 feature_value = breakdown_value
@@ -538,24 +895,16 @@ class DataService():
         else:
             feature_value = [feature_value]
 
-        similar_iid = []
-        similar_sid = []
-        similar_insight_name = []
+        rows = []
         for value in feature_value:
             if value == '*':
                 continue
-            similar_subspace = subspace_data.loc[subspace_data[feature] == value]
-            similar_iid.extend(similar_subspace['iid'].tolist())
-            similar_sid.extend(similar_subspace['sid'].tolist())
-            similar_insight_name.extend(similar_subspace['insight'].tolist())
-
-            similar_subspace = subspace_data.loc[subspace_data['breakdown_value'] == value]
-            similar_iid.extend(similar_subspace['iid'].tolist())
-            similar_sid.extend(similar_subspace['sid'].tolist())
-            similar_insight_name.extend(similar_subspace['insight'].tolist())
+            rows.append(index.features[feature][value])
+            rows.append(index.breakdown_value[value])
+        rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
 
         return {
-            'similar_iid': similar_iid,
-            'similar_sid': similar_sid,
-            'similar_insight_name': similar_insight_name
+            'similar_iid': index.iid[rows].tolist(),
+            'similar_sid': index.sid[rows].tolist(),
+            'similar_insight_name': index.insight[rows].tolist()
         }
@@ -0,0 +1,193 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from dataService import columnStore
+from dataService.metrics import METRICS
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+DATASET_CACHE_BUDGET = int(os.environ.get('V4I_DATASET_CACHE_MB', '1024')) * 1024 * 1024
+
+
+def estimate_nbytes(obj, depth=0):
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=False, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=False, deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if depth < 3:
+        if isinstance(obj, dict):
+            return sys.getsizeof(obj) + sum(estimate_nbytes(v, depth + 1) for v in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return sys.getsizeof(obj) + sum(estimate_nbytes(v, depth + 1) for v in obj)
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    return sys.getsizeof(obj)
+
+
+class Dataset():
+    def __init__(self, registry, name, version):
+        self.name = name
+        self.version = version
+        self.nbytes = 0
+        self.__registry = registry
+        self.__tables = dict()
+        self.__derived = dict()
+        # (cache, key) -> Future of what is being loaded or built for it right now
+        self.__pending = dict()
+        self.__lock = threading.Lock()
+
+    def table(self, kind):
+        def load():
+            with METRICS.span('load'):
+                return columnStore.load_table(kind, self.name)
+        return self.__once(self.__tables, 'table', kind, load)
+
+    def derived(self, key, builder):
+        # artefacts built from the tables live and die with this version of the dataset
+        return self.__once(self.__derived, 'derived', key, builder)
+
+    def __once(self, store, cache, key, build):
+        # build runs without the lock, at most once per key at a time: callers of the same key
+        # wait for its result, callers of any other key are not held up
+        with self.__lock:
+            if key in store:
+                self.__registry.record_hit(cache, key)
+                return store[key]
+            pending = self.__pending.get((cache, key))
+            building = pending is None
+            if building:
+                pending = self.__pending[(cache, key)] = Future()
+        if not building:
+            self.__registry.record_hit(cache, key)
+            return pending.result()
+
+        self.__registry.record_miss(cache, key)
+        try:
+            value = build()
+            nbytes = estimate_nbytes(value)
+        except BaseException as e:
+            with self.__lock:
+                del self.__pending[(cache, key)]
+            pending.set_exception(e)
+            raise
+        with self.__lock:
+            store[key] = value
+            self.nbytes += nbytes
+            del self.__pending[(cache, key)]
+        pending.set_result(value)
+        self.__registry.enforce_budget()
+        return value
+
+    def cached(self, key):
+        # a derived artefact if it has been built, without building it
+        with self.__lock:
+            return self.__derived.get(key)
+
+    def cached_items(self):
+        with self.__lock:
+            return list(self.__derived.items())
+
+    def put_table(self, kind, df):
+        with self.__lock:
+            self.__tables[kind] = df
+            self.nbytes += estimate_nbytes(df)
+
+    def put_derived(self, key, value):
+        # for artefacts carried over from or updated against an earlier version
+        with self.__lock:
+            self.__derived[key] = value
+            self.nbytes += estimate_nbytes(value)
+
+    def account(self, nbytes):
+        # for artefacts that fill up incrementally after they were created
+        with self.__lock:
+            self.nbytes += nbytes
+        self.__registry.enforce_budget()
+
+
+class DatasetRegistry():
+    def __init__(self, budget=DATASET_CACHE_BUDGET, on_load=None):
+        self.budget = budget
+        self.on_load = on_load
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__datasets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def version(self, name):
+        stamps = []
+        for kind in columnStore.KINDS:
+            try:
+                stamps.append(tuple(columnStore.source_stamp(kind, name)))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def get(self, name, notify=True):
+        version = self.version(name)
+        loaded = False
+        with self.__lock:
+            dataset = self.__datasets.get(name)
+            if dataset is None or dataset.version != version:
+                dataset = Dataset(self, name, version)
+                self.__datasets[name] = dataset
+                loaded = True
+            self.__datasets.move_to_end(name)
+        if loaded and notify and self.on_load is not None:
+            # precompute in the background so the first request is not held up
+            threading.Thread(target=self.on_load, args=(dataset,), daemon=True).start()
+        return dataset
+
+    def publish(self, dataset):
+        # installs a dataset that was put together outside the registry, e.g. after an ingest
+        with self.__lock:
+            self.__datasets[dataset.name] = dataset
+            self.__datasets.move_to_end(dataset.name)
+        self.enforce_budget()
+        if self.on_load is not None:
+            threading.Thread(target=self.on_load, args=(dataset,), daemon=True).start()
+        return dataset
+
+    def is_current(self, dataset):
+        with self.__lock:
+            return self.__datasets.get(dataset.name) is dataset \
+                and self.version(dataset.name) == dataset.version
+
+    def record_hit(self, cache, key):
+        with self.__lock:
+            self.hits += 1
+        # 'density:<column>' and the like are counted under their prefix
+        METRICS.count('v4i_cache_requests_total', cache=cache, key=key.split(':')[0], result='hit')
+
+    def record_miss(self, cache, key):
+        with self.__lock:
+            self.misses += 1
+        METRICS.count('v4i_cache_requests_total', cache=cache, key=key.split(':')[0], result='miss')
+
+    def enforce_budget(self):
+        with self.__lock:
+            # least recently used datasets go first; the one in use is always kept
+            while len(self.__datasets) > 1 \
+                    and sum(d.nbytes for d in self.__datasets.values()) > self.budget:
+                self.__datasets.popitem(last=False)
+                self.evictions += 1
+                METRICS.count('v4i_dataset_evictions_total')
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'budget': self.budget,
+                'nbytes': sum(d.nbytes for d in self.__datasets.values()),
+                'datasets': {name: d.nbytes for name, d in self.__datasets.items()}
+            }
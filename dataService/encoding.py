@@ -0,0 +1,93 @@
+import zlib
+
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# bodies smaller than this are sent as they are; compressing them saves nothing worth the time
+MIN_COMPRESS_BYTES = 1024
+
+
+def offered_mimetypes():
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def choose_mimetype(accept):
+    # accept: the request's werkzeug MIMEAccept; JSON unless the client prefers msgpack
+    return accept.best_match(offered_mimetypes(), default=JSON) or JSON
+
+
+def _pack_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('cannot pack {!r}'.format(type(value)))
+
+
+def packb(data):
+    return msgpack.packb(data, default=_pack_default, use_bin_type=True)
+
+
+def choose_coding(accept_encodings):
+    # accept_encodings: the request's werkzeug Accept; zstd over gzip when both are accepted
+    codings = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+    coding = accept_encodings.best_match(codings)
+    return coding if coding is not None and accept_encodings[coding] > 0 else None
+
+
+def _compressor(coding):
+    if coding == 'zstd':
+        compressobj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return compressobj.compress, lambda: compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressobj.flush
+    # wbits 31: a gzip header and trailer around the deflate stream
+    compressobj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressobj.compress, lambda: compressobj.flush(zlib.Z_SYNC_FLUSH), compressobj.flush
+
+
+def compress(data, coding):
+    write, _, finish = _compressor(coding)
+    return write(data) + finish()
+
+
+def _compress_chunks(chunks, coding):
+    # every chunk is flushed as it comes, so a streamed response still arrives progressively
+    write, flush, finish = _compressor(coding)
+    for chunk in chunks:
+        out = write(chunk) + flush()
+        if out:
+            yield out
+    yield finish()
+
+
+def compress_response(response, accept_encodings):
+    response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or 'Content-Encoding' in response.headers:
+        return response
+    coding = choose_coding(accept_encodings)
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_chunks(response.iter_encoded(), coding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_BYTES:
+            return response
+        response.set_data(compress(data, coding))
+    response.headers['Content-Encoding'] = coding
+    return response
@@ -0,0 +1,195 @@
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+class CsrIndex():
+    # groups `values` by the integer `keys`: the values of key k are values[offsets[k]:offsets[k + 1]]
+    def __init__(self, keys, values, size=None):
+        keys = np.asarray(keys)
+        if size is None:
+            size = int(keys.max()) + 1 if len(keys) > 0 else 0
+        order = np.argsort(keys, kind='stable')
+        self.values = np.asarray(values)[order]
+        self.offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=size), out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if key < 0 or key >= len(self):
+            return self.values[0:0]
+        return self.values[self.offsets[key]:self.offsets[key + 1]]
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+
+class SubspaceIndex():
+    def __init__(self, sid_cid, record):
+        sid = sid_cid['sid'].to_numpy()
+        cid = sid_cid['cid'].to_numpy()
+        # row position of every cid in the record table; memberships without a record are dropped
+        rows = pd.Index(record['cid'].to_numpy()).get_indexer(cid)
+        found = rows >= 0
+        sid, cid, rows = sid[found], cid[found], rows[found]
+
+        self.sid_to_row = CsrIndex(sid, rows)
+        self.sid_to_cid = CsrIndex(sid, cid)
+        self.cid_to_sid = CsrIndex(cid, sid)
+
+    def rows_of_sid(self, sid):
+        return self.sid_to_row[sid]
+
+    def cids_of_sid(self, sid):
+        return self.sid_to_cid[sid]
+
+    def sids_of_cid(self, cid):
+        return self.cid_to_sid[cid]
+
+
+def gather(csr, keys):
+    # concatenation of csr[k] for every k in keys, plus the length each key contributed
+    keys = np.asarray(keys)
+    valid = (keys >= 0) & (keys < len(csr))
+    safe_keys = np.where(valid, keys, 0)
+    starts = csr.offsets[safe_keys]
+    lengths = np.where(valid, csr.offsets[safe_keys + 1] - starts, 0)
+    return csr.values[_ranges(starts, lengths)], lengths
+
+
+def ranked_groups(keys, values):
+    # groups values by key, ranked by group size (largest first, ties by key)
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    unique, index, counts = np.unique(keys, return_index=True, return_counts=True)
+    rank = np.lexsort((unique, -counts))
+    counts = counts[rank]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return unique[rank], counts, offsets, values[_ranges(index[rank], counts)]
+
+
+def merge_ranked_groups(first, second):
+    # ranked_groups over the pairs behind two results whose keys do not overlap
+    keys = np.concatenate((first[0], second[0]))
+    counts = np.concatenate((first[1], second[1]))
+    starts = np.concatenate((first[2][:-1], second[2][:-1] + len(first[3])))
+    values = np.concatenate((first[3], second[3]))
+    rank = np.lexsort((keys, -counts))
+    counts = counts[rank]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return keys[rank], counts, offsets, values[_ranges(starts[rank], counts)]
+
+
+def _ranges(starts, lengths):
+    # [starts[0], starts[0] + lengths[0]) + [starts[1], ...) as one index array
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(starts - (ends - lengths), lengths)
+
+
+def dictionary_codes(values):
+    # integer codes of a column and the values they stand for; categoricals already carry both
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), values.cat.categories.to_numpy(dtype=object)
+    return pd.factorize(values.to_numpy())
+
+
+def value_counts(values):
+    # values.value_counts() as an object column gives it: count descending, first appearance
+    # on ties and only values that occur, counted on the integer codes
+    codes, uniques = dictionary_codes(values)
+    valid = codes[codes >= 0]
+    counts = np.bincount(valid, minlength=len(uniques))
+    _, first = np.unique(valid, return_index=True)
+    appearance = valid[np.sort(first)]
+    order = appearance[np.argsort(-counts[appearance], kind='stable')]
+    return pd.Series(counts[order], index=pd.Index(uniques[order], name=values.name), name='count')
+
+
+class InvertedIndex():
+    # maps each distinct value to the sorted positions of the rows holding it
+    def __init__(self, codes, uniques):
+        codes = np.asarray(codes)
+        valid = codes >= 0
+        self.__postings = CsrIndex(codes[valid], np.flatnonzero(valid), size=len(uniques))
+        self.__lookup = {value: code for code, value in enumerate(uniques)}
+
+    @classmethod
+    def from_values(cls, values):
+        codes, uniques = pd.factorize(values)
+        return cls(codes, uniques)
+
+    def __getitem__(self, value):
+        code = self.__lookup.get(value)
+        if code is None:
+            return self.__postings.values[0:0]
+        return self.__postings[code]
+
+
+class SimilarInsightIndex():
+    def __init__(self, insight, subspace, features):
+        # rows of the insight/subspace inner join on sid, in the order pd.merge(subspace, insight) gives
+        sub_row = pd.Index(subspace['sid'].to_numpy()).get_indexer(insight['sid'].to_numpy())
+        joined = np.flatnonzero(sub_row >= 0)
+        order = joined[np.argsort(sub_row[joined], kind='stable')]
+        sub_row = sub_row[order]
+
+        self.iid = insight['iid'].to_numpy()[order]
+        self.sid = insight['sid'].to_numpy()[order]
+        self.insight = insight['insight'].to_numpy()[order]
+        unique_sid, first_row = np.unique(self.sid, return_index=True)
+        self.__first_row = dict(zip(unique_sid.tolist(), first_row.tolist()))
+
+        self.__feature_codes = dict()
+        self.__feature_values = dict()
+        self.features = dict()
+        for feature in features:
+            codes, uniques = dictionary_codes(subspace[feature])
+            self.__feature_codes[feature] = codes[sub_row]
+            self.__feature_values[feature] = uniques
+            self.features[feature] = InvertedIndex(self.__feature_codes[feature], uniques)
+        self.breakdown_value = InvertedIndex.from_values(insight['breakdown_value'].to_numpy()[order])
+
+    def feature_value(self, sid, feature):
+        code = self.__feature_codes[feature][self.__first_row[sid]]
+        return self.__feature_values[feature][code] if code >= 0 else np.nan
+
+
+class EdgeIndex():
+    # edges ranked by jaccard_index (highest first, file order on ties); every node lists the
+    # ranks of its edges in ascending order, so a threshold keeps a prefix of each list
+    def __init__(self, edge):
+        source = edge['source'].to_numpy()
+        target = edge['target'].to_numpy()
+        jaccard = edge['jaccard_index'].to_numpy()
+        order = np.lexsort((np.arange(len(jaccard)), -jaccard))
+        self.source = source[order]
+        self.target = target[order]
+        self.jaccard = jaccard[order]
+
+        size = int(max(source.max(), target.max())) + 1 if len(order) > 0 else 0
+        ranks = np.arange(len(order))
+        self.by_source = CsrIndex(self.source, ranks, size)
+        self.by_target = CsrIndex(self.target, ranks, size)
+
+    def count_above(self, min_jaccard):
+        return int(np.searchsorted(-self.jaccard, -min_jaccard, side='right'))
+
+    def query(self, min_jaccard=0., nodes=None, mode='any'):
+        # ranks of the matching edges, ascending; mode 'both' keeps edges whose ends are both in nodes
+        count = self.count_above(min_jaccard)
+        if nodes is None:
+            return np.arange(count)
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        ranks, _ = gather(self.by_source, nodes)
+        ranks = ranks[ranks < count]
+        if mode == 'both':
+            ranks = ranks[np.isin(self.target[ranks], nodes)]
+        else:
+            target_ranks, _ = gather(self.by_target, nodes)
+            ranks = np.union1d(ranks, target_ranks[target_ranks < count])
+        return np.sort(ranks)
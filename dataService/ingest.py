@@ -0,0 +1,111 @@
+import os
+import shutil
+import sys
+
+from dataService import columnStore
+from dataService.indexes import dictionary_codes
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# subspace rows x new rows compared at once while matching
+MATCH_CHUNK = 1 << 22
+
+
+class IngestError(ValueError):
+    pass
+
+
+def dataset_lock(name):
+    # one ingest per dataset at a time, across every process on this machine; the tables and
+    # the cube are then locked one by one as they are rewritten
+    return columnStore.file_lock('dataset_{}'.format(name))
+
+
+def prepare_records(record, records):
+    # the new rows in the record table's column order and dtypes, numbered on from the last cid
+    new = pd.DataFrame(records)
+    columns = [col for col in record.columns if col != 'cid']
+    missing = [col for col in columns if col not in new.columns]
+    if len(new) == 0:
+        raise IngestError('no records to append')
+    if missing:
+        raise IngestError('records lack the columns {}'.format(', '.join(missing)))
+    new = new[columns].copy()
+    for col in columns:
+        dtype = record[col].dtype
+        if dtype.kind in 'biuf':
+            values = pd.to_numeric(new[col], errors='coerce')
+            if values.isna().any() and dtype.kind != 'f':
+                raise IngestError('column {} needs a number in every record'.format(col))
+            new[col] = values.astype(dtype)
+        else:
+            new[col] = new[col].astype(object).where(new[col].notna(), None)
+    # cids need not be dense, so the row count could hand out one that is taken
+    first = int(record['cid'].max()) + 1 if len(record) > 0 else 0
+    new['cid'] = np.arange(first, first + len(new), dtype=record['cid'].dtype)
+    return new[list(record.columns)]
+
+
+def match_subspaces(subspace, features, rows):
+    # (sid, row position) of every subspace pattern each new row falls into; a pattern matches
+    # a row when each feature is '*' or equals the row's value, compared as text
+    pattern_codes = []
+    row_codes = []
+    wildcards = []
+    for feature in features:
+        codes, uniques = dictionary_codes(subspace[feature])
+        uniques = pd.Index([str(value) for value in uniques])
+        pattern_codes.append(codes)
+        wildcards.append(uniques.get_indexer([columnStore.WILDCARD])[0])
+        values = rows[feature].to_numpy(dtype=object)
+        row_codes.append(np.where(pd.isna(values), -2, uniques.get_indexer(values.astype(str))))
+
+    sids = subspace['sid'].to_numpy()
+    chunk = max(1, MATCH_CHUNK // max(1, len(sids)))
+    matched_sids, matched_rows = [], []
+    for start in range(0, len(rows), chunk):
+        stop = min(start + chunk, len(rows))
+        match = np.ones((len(sids), stop - start), dtype=bool)
+        for codes, values, wildcard in zip(pattern_codes, row_codes, wildcards):
+            match &= (codes[:, None] == wildcard) | (codes[:, None] == values[None, start:stop])
+        sub_row, row = np.nonzero(match)
+        matched_sids.append(sids[sub_row])
+        matched_rows.append(row + start)
+    sid = np.concatenate(matched_sids) if matched_sids else np.zeros(0, dtype=np.int64)
+    row = np.concatenate(matched_rows) if matched_rows else np.zeros(0, dtype=np.int64)
+    # the sid_cid files list each subspace's members together, by cid
+    order = np.lexsort((row, sid))
+    return sid[order], row[order]
+
+
+def append_csv(kind, name, df):
+    # writes CSV + rows to a copy and renames it over the original, so readers see either
+    path = columnStore.csv_path(kind, name)
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    shutil.copyfile(path, tmp_path)
+    with open(tmp_path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    df.to_csv(tmp_path, mode='a', header=False, index=False)
+    os.replace(tmp_path, path)
+
+
+def main():
+    # python -m dataService.ingest NAME FILE.csv: appends the rows of FILE.csv to dataset NAME
+    from dataService.dataService import DataService
+    if len(sys.argv) != 3:
+        print('usage: python -m dataService.ingest NAME FILE.csv')
+        sys.exit(2)
+    name, file_name = sys.argv[1:]
+    result = DataService().append_records(name, pd.read_csv(file_name).to_dict('records'))
+    print('appended {} records to {}, now members of {} subspaces'.format(
+        len(result['cid']), name, result['subspace_count']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import json
+
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CHUNK_ROWS = 4096
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    return json.dumps(value)
+
+
+def encode_column(values):
+    # one JSON token per value, computed from the whole array at once; missing values become null
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu':
+        return dumps(values.tolist())[1:-1].replace(' ', '').split(',') if len(values) > 0 else []
+    if values.dtype.kind == 'f':
+        tokens = np.array(dumps(values.tolist())[1:-1].replace(' ', '').split(','), dtype=object) \
+            if len(values) > 0 else np.zeros(0, dtype=object)
+        tokens[np.isnan(values)] = 'null'
+        return tokens.tolist()
+    # strings may contain commas, so each distinct value is encoded on its own
+    codes, uniques = pd.factorize(values)
+    tokens = np.array([dumps(value) for value in uniques] + ['null'], dtype=object)
+    return tokens.take(codes).tolist()
+
+
+class Records():
+    # a frame that serializes like df.to_dict('records')
+    def __init__(self, df):
+        self.df = df
+
+    def to_python(self):
+        return self.df.to_dict('records')
+
+    def _template(self):
+        return ', '.join(dumps(str(col)).replace('%', '%%') + ': %s' for col in self.df.columns)
+
+    def _keys(self, start, stop):
+        return None
+
+    def iter_json(self, chunk_rows=CHUNK_ROWS):
+        template = '{' + self._template() + '}'
+        for start in range(0, len(self.df), chunk_rows):
+            chunk = self.df.iloc[start:start + chunk_rows]
+            rows = [template % parts for parts in zip(*[encode_column(chunk[col].to_numpy()) for col in chunk.columns])]
+            keys = self._keys(start, start + len(chunk))
+            if keys is not None:
+                rows = [key + ': ' + row for key, row in zip(keys, rows)]
+            yield (', ' if start > 0 else '') + ', '.join(rows)
+
+
+class IndexedRecords(Records):
+    # a frame that serializes like df.to_dict('index')
+    def to_python(self):
+        return self.df.to_dict('index')
+
+    def _keys(self, start, stop):
+        return [dumps(str(key)) for key in self.df.index[start:stop]]
+
+
+def iter_object(sections):
+    # streams {key: value, ...}; Records sections are written a chunk at a time
+    yield '{'
+    for i, (key, value) in enumerate(sections):
+        yield (', ' if i > 0 else '') + dumps(key) + ': '
+        if isinstance(value, IndexedRecords):
+            yield '{'
+            for chunk in value.iter_json():
+                yield chunk
+            yield '}'
+        elif isinstance(value, Records):
+            yield '['
+            for chunk in value.iter_json():
+                yield chunk
+            yield ']'
+        else:
+            yield dumps(value)
+    yield '}'
@@ -0,0 +1,62 @@
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+# same defaults as seaborn.kdeplot, whose curves this replaces
+GRID_SIZE = 200
+CUT = 3
+# below this many point/grid-point pairs the density is summed exactly
+EXACT_LIMIT = 1 << 21
+MIN_BINS = 1 << 10
+MAX_BINS = 1 << 18
+BINS_PER_BANDWIDTH = 16
+
+
+def scott_bandwidth(values):
+    return np.std(values, ddof=1) * len(values) ** (-1. / 5)
+
+
+def gaussian_kde_grid(values, gridsize=GRID_SIZE, cut=CUT, binned=False):
+    # binned: always take the FFT path, e.g. for a sample, whose own error dwarfs the binning's
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if len(values) < 2 or np.ptp(values) == 0:
+        # no spread to estimate a density from
+        point = values[0] if len(values) > 0 else 0.
+        return np.array([point]), np.array([0.])
+
+    bw = scott_bandwidth(values)
+    x = np.linspace(values.min() - bw * cut, values.max() + bw * cut, gridsize)
+    if not binned and len(values) * gridsize <= EXACT_LIMIT:
+        y = _direct_density(values, x, bw)
+    else:
+        y = _binned_density(values, x, bw)
+    return x, y
+
+
+def _direct_density(values, x, bw):
+    y = np.zeros(len(x))
+    chunk = max(1, EXACT_LIMIT // (4 * len(x)))
+    for start in range(0, len(values), chunk):
+        z = (x[:, None] - values[None, start:start + chunk]) / bw
+        y += np.exp(-0.5 * z * z).sum(axis=1)
+    return y / (len(values) * bw * np.sqrt(2 * np.pi))
+
+
+def _binned_density(values, x, bw):
+    # linear binning onto a fine grid, then one FFT convolution with the sampled Gaussian
+    lo, hi = x[0], x[-1]
+    bins = int(np.clip(2 ** np.ceil(np.log2((hi - lo) / bw * BINS_PER_BANDWIDTH)), MIN_BINS, MAX_BINS))
+    delta = (hi - lo) / (bins - 1)
+    pos = (values - lo) / delta
+    left = np.clip(np.floor(pos).astype(np.int64), 0, bins - 2)
+    frac = pos - left
+    counts = np.bincount(left, weights=1 - frac, minlength=bins) \
+        + np.bincount(left + 1, weights=frac, minlength=bins)
+
+    offsets = np.arange(-(bins - 1), bins) * delta
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2)
+    size = 1 << int(np.ceil(np.log2(3 * bins - 2)))
+    density = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+    density = density[bins - 1:2 * bins - 1] / (len(values) * bw * np.sqrt(2 * np.pi))
+    return np.interp(x, lo + np.arange(bins) * delta, np.maximum(density, 0))
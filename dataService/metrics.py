@@ -0,0 +1,159 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.]
+# '-' writes one JSON line per request to stderr, any other value appends them to that file
+REQUEST_LOG = os.environ.get('V4I_REQUEST_LOG', '')
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics():
+    # process-wide counters and latency histograms, plus the spans of the request the current
+    # thread is serving; rendered in the Prometheus text format
+    def __init__(self, log=REQUEST_LOG):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__counters = dict()
+        self.__histograms = dict()
+        self.__help = dict()
+        self.__log = log
+        self.__log_lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.__help[name] = (kind, text)
+
+    def count(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, phase):
+        # times a phase of the work into v4i_phase_seconds and into the current request's spans
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('v4i_phase_seconds', seconds, phase=phase)
+            spans = getattr(self.__local, 'spans', None)
+            if spans is not None:
+                spans[phase] = spans.get(phase, 0.) + seconds
+
+    def begin_request(self, **fields):
+        self.__local.spans = dict()
+        self.__local.fields = dict(fields)
+        self.__local.start = time.perf_counter()
+
+    def annotate(self, **fields):
+        # adds fields (dataset, iid, insight type ...) to the current request's log line
+        if getattr(self.__local, 'fields', None) is not None:
+            self.__local.fields.update(fields)
+
+    def end_request(self, endpoint, status):
+        start = getattr(self.__local, 'start', None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        self.observe('v4i_request_seconds', seconds, endpoint=endpoint, status=status)
+        if self.__log:
+            line = dict(self.__local.fields, endpoint=endpoint, status=status, ms=round(seconds * 1000., 3),
+                        spans={phase: round(s * 1000., 3) for phase, s in self.__local.spans.items()})
+            self.__write_log(json.dumps(line, default=str))
+        self.__local.spans = None
+        self.__local.fields = None
+        self.__local.start = None
+
+    def __write_log(self, line):
+        with self.__log_lock:
+            if self.__log == '-':
+                sys.stderr.write(line + '\n')
+                sys.stderr.flush()
+            else:
+                with open(self.__log, 'a') as f:
+                    f.write(line + '\n')
+
+    def render(self, gauges=()):
+        # gauges: (name, help, [(labels dict, value)]) sampled by the caller at scrape time
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(self.__histograms.items(), key=lambda item: item[0])
+            snapshot = [(key, list(h.buckets), list(h.counts), h.count, h.sum) for key, h in histograms]
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = self.__help.get(name, (kind, name))
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        for (name, labels), buckets, counts, count, total in snapshot:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', repr(bound))]), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', '+Inf')]), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), repr(total)))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        for name, text, samples in gauges:
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _format_labels(_labels(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.describe('v4i_request_seconds', 'histogram', 'Time spent serving a request, by endpoint and status.')
+METRICS.describe('v4i_phase_seconds', 'histogram', 'Time spent in a phase of the work: load, merge, aggregate, '
+                                                   'analytics, kde, render, serialize or compress.')
+METRICS.describe('v4i_cache_requests_total', 'counter', 'Dataset cache lookups, by cache, key and result.')
+METRICS.describe('v4i_dataset_evictions_total', 'counter', 'Datasets dropped from the cache to stay within its budget.')
+METRICS.describe('v4i_response_cache_total', 'counter', 'Response cache lookups: hit, miss or not_modified (304).')
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from dataService import encoding
+from dataService.metrics import METRICS
+
+RESPONSE_CACHE_BUDGET = int(os.environ.get('V4I_RESPONSE_CACHE_MB', '256')) * 1024 * 1024
+# part of every ETag, so a change to what the endpoints return can invalidate clients' copies
+FORMAT_VERSION = 1
+
+
+def cache_key(endpoint, params, mimetype, version):
+    return json.dumps([FORMAT_VERSION, endpoint, params, mimetype, version], sort_keys=True,
+                      separators=(',', ':'), default=str)
+
+
+def etag_for(key):
+    # derived from the key rather than the body, so it is known before anything is computed
+    # and the same in every worker; sent as a weak tag since the body has several codings
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class CachedResponse():
+    def __init__(self, etag, body, mimetype):
+        self.etag = etag
+        self.mimetype = mimetype
+        self.bodies = {None: body}
+        self.nbytes = len(body)
+
+    def body(self, coding):
+        # the body in the given content coding, compressed once and kept
+        if coding is None or len(self.bodies[None]) < encoding.MIN_COMPRESS_BYTES:
+            return None, self.bodies[None]
+        body = self.bodies.get(coding)
+        if body is None:
+            body = self.bodies[coding] = encoding.compress(self.bodies[None], coding)
+            self.nbytes += len(body)
+        return coding, body
+
+
+class ResponseCache():
+    # serialized response bodies of endpoints that only change with the dataset files, least
+    # recently used first out once the byte budget is exceeded
+    def __init__(self, budget=RESPONSE_CACHE_BUDGET):
+        self.budget = budget
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+        METRICS.count('v4i_response_cache_total', result='hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, key, body, mimetype):
+        entry = CachedResponse(etag_for(key), body, mimetype)
+        with self.__lock:
+            self.__entries[key] = entry
+        self.enforce_budget()
+        return entry
+
+    def body(self, entry, coding):
+        coding, body = entry.body(coding)
+        self.enforce_budget()
+        return coding, body
+
+    def enforce_budget(self):
+        with self.__lock:
+            # the entry just stored or used is kept even if it alone exceeds the budget
+            while len(self.__entries) > 1 and self.nbytes() > self.budget:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.__entries.values())
+
+    def stats(self):
+        with self.__lock:
+            return {'entries': len(self.__entries), 'nbytes': self.nbytes(), 'budget': self.budget}
@@ -0,0 +1,24 @@
+import math
+
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+
+def sample_size_for_error(error, confidence=0.95):
+    # DKW bound: this many samples keep the empirical CDF within `error` of the true one, and
+    # every value's share of the rows with it
+    return int(math.ceil(math.log(2 / (1 - confidence)) / (2 * error * error)))
+
+
+def sample_rows(n, size, seed=0):
+    # ascending positions of a uniform sample without replacement of n rows, every row when
+    # there are no more than size; the table is in memory, so the rows are drawn directly
+    if n <= size:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(seed).choice(n, size, replace=False))
+
+
+def estimate_counts(counts, sample_size, n):
+    # counts over a uniform sample of sample_size rows scaled up to the n rows it was drawn from
+    return np.rint(np.asarray(counts) * (n / sample_size)).astype(np.int64)
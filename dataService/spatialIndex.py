@@ -0,0 +1,88 @@
+from dataService.indexes import CsrIndex, gather
+from dataService.startup import lazy_import
+
+np = lazy_import('numpy')
+
+POINTS_PER_CELL = 4
+
+
+class GridIndex():
+    # uniform grid over 2-D points: each cell lists the rows that fall into it
+    def __init__(self, points, points_per_cell=POINTS_PER_CELL):
+        self.points = np.asarray(points, dtype=np.float64)
+        rows = np.flatnonzero(np.isfinite(self.points).all(axis=1))
+        if len(rows) == 0:
+            self.lo = np.zeros(2)
+            self.hi = np.zeros(2)
+        else:
+            self.lo = self.points[rows].min(axis=0)
+            self.hi = self.points[rows].max(axis=0)
+        self.shape = np.full(2, max(1, int(np.ceil(np.sqrt(len(rows) / points_per_cell)))))
+        extent = np.maximum(self.hi - self.lo, np.finfo(np.float64).eps)
+        self.cell_size = extent / self.shape
+
+        cx, cy = self.__cell_of(self.points[rows])
+        self.cells = CsrIndex(cy * self.shape[0] + cx, rows, int(self.shape[0] * self.shape[1]))
+
+    def __cell_of(self, points):
+        cell = np.floor((np.atleast_2d(points) - self.lo) / self.cell_size).astype(np.int64)
+        cell = np.clip(cell, 0, self.shape - 1)
+        return cell[:, 0], cell[:, 1]
+
+    def __rows_in_cells(self, x0, x1, y0, y1):
+        cx, cy = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+        rows, _ = gather(self.cells, (cy * self.shape[0] + cx).ravel())
+        return rows
+
+    def range(self, x0, y0, x1, y1):
+        # rows inside the closed rectangle, ascending
+        if x0 > self.hi[0] or x1 < self.lo[0] or y0 > self.hi[1] or y1 < self.lo[1]:
+            return np.zeros(0, dtype=np.int64)
+        (cx0, cx1), (cy0, cy1) = self.__cell_of(np.array([[x0, y0], [x1, y1]]))
+        rows = self.__rows_in_cells(cx0, cx1, cy0, cy1)
+        p = self.points[rows]
+        inside = (p[:, 0] >= x0) & (p[:, 0] <= x1) & (p[:, 1] >= y0) & (p[:, 1] <= y1)
+        return np.sort(rows[inside])
+
+    def nearest(self, x, y, k):
+        # the k rows closest to (x, y) and their distances, nearest first
+        query = np.array([x, y], dtype=np.float64)
+        cx, cy = self.__cell_of(query)
+        cx, cy = int(cx[0]), int(cy[0])
+        rows = np.zeros(0, dtype=np.int64)
+        radius = 0
+        while True:
+            ring = []
+            for (x0, x1, y0, y1) in self.__ring(cx, cy, radius):
+                ring.append(self.__rows_in_cells(x0, x1, y0, y1))
+            rows = np.concatenate([rows] + ring)
+            distance = np.hypot(*(self.points[rows] - query).T)
+            exhausted = cx - radius <= 0 and cy - radius <= 0 \
+                and cx + radius >= self.shape[0] - 1 and cy + radius >= self.shape[1] - 1
+            # anything outside the searched block is at least `radius` cells away from the
+            # query (or from its projection onto the grid, which is no farther)
+            if exhausted or (len(rows) >= k and np.partition(distance, k - 1)[k - 1] <= radius * self.cell_size.min()):
+                break
+            radius += 1
+        order = np.lexsort((rows, distance))[0:k]
+        return rows[order], distance[order]
+
+    def __ring(self, cx, cy, radius):
+        # cell blocks (x0, x1, y0, y1) at Chebyshev distance exactly `radius`, clipped to the grid
+        nx, ny = self.shape
+        x0, x1 = max(cx - radius, 0), min(cx + radius, nx - 1)
+        y0, y1 = max(cy - radius, 0), min(cy + radius, ny - 1)
+        if radius == 0:
+            return [(x0, x1, y0, y1)]
+        blocks = []
+        if cy - radius >= 0:
+            blocks.append((x0, x1, cy - radius, cy - radius))
+        if cy + radius <= ny - 1:
+            blocks.append((x0, x1, cy + radius, cy + radius))
+        inner_y0, inner_y1 = max(cy - radius + 1, 0), min(cy + radius - 1, ny - 1)
+        if inner_y0 <= inner_y1:
+            if cx - radius >= 0:
+                blocks.append((cx - radius, cx - radius, inner_y0, inner_y1))
+            if cx + radius <= nx - 1:
+                blocks.append((cx + radius, cx + radius, inner_y0, inner_y1))
+        return blocks
@@ -0,0 +1,84 @@
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StartupProfile():
+    # where startup time went: module imports and per-dataset load / warm-up, in seconds
+    def __init__(self):
+        self.imports = OrderedDict()
+        self.datasets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record_import(self, name, seconds):
+        with self.lock:
+            self.imports[name] = self.imports.get(name, 0.) + seconds
+
+    @contextmanager
+    def importing(self, name):
+        # times the import statements of its block, for modules that are imported eagerly
+        start = time.perf_counter()
+        yield
+        self.record_import(name, time.perf_counter() - start)
+
+    def record_dataset(self, name, step, seconds):
+        with self.lock:
+            steps = self.datasets.setdefault(name, OrderedDict())
+            steps[step] = steps.get(step, 0.) + seconds
+
+    def total(self):
+        return sum(self.imports.values()) + sum(sum(steps.values()) for steps in self.datasets.values())
+
+    def report(self, budget=None):
+        lines = ['imports']
+        for name, seconds in self.imports.items():
+            lines.append('  {:<40} {:8.3f}s'.format(name, seconds))
+        lines.append('datasets')
+        for name, steps in self.datasets.items():
+            lines.append('  {:<40} {:8.3f}s  ({})'.format(name, sum(steps.values()), ', '.join(
+                '{} {:.3f}s'.format(step, seconds) for step, seconds in steps.items())))
+        lines.append('{:<42} {:8.3f}s'.format('total', self.total()))
+        if budget is not None:
+            lines.append('{:<42} {:8.3f}s  {}'.format('budget', budget, 'ok' if self.total() <= budget else 'EXCEEDED'))
+        return '\n'.join(lines)
+
+
+PROFILE = StartupProfile()
+_import_lock = threading.RLock()
+
+
+class LazyModule():
+    # stands in for a module until an attribute is first used, then imports it once
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def _load(self):
+        module = self.__dict__.get('_module')
+        if module is None:
+            with _import_lock:
+                module = sys.modules.get(self._name)
+                if module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    PROFILE.record_import(self._name, time.perf_counter() - start)
+                self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        # later lookups of the same attribute hit the instance dict and skip this method
+        self.__dict__[attr] = value
+        return value
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,50 @@
+# Production entry point:
+#     gunicorn -c gunicorn.conf.py wsgi
+# V4I_WORKERS / V4I_THREADS size the worker pool, V4I_BIND sets the address and
+# V4I_DATA_POLL_INTERVAL how often (seconds) the master checks data/ for changes.
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+bind = os.environ.get('V4I_BIND', '0.0.0.0:8888')
+workers = int(os.environ.get('V4I_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('V4I_THREADS', '2'))
+worker_class = 'gthread'
+preload_app = True
+timeout = 120
+graceful_timeout = 60
+
+DATA_POLL_INTERVAL = float(os.environ.get('V4I_DATA_POLL_INTERVAL', '10'))
+
+
+WATCHER_NAME = 'v4i-data-watcher'
+
+
+def _watch_data(server):
+    # only stats files and signals: it must hold no lock a worker forked meanwhile could inherit
+    import wsgi
+    versions = wsgi.dm.get_data_versions()
+    while True:
+        time.sleep(DATA_POLL_INTERVAL)
+        latest = wsgi.dm.get_data_versions()
+        if latest == versions:
+            continue
+        server.log.info('data changed, reloading datasets')
+        versions = latest
+        os.kill(os.getpid(), signal.SIGHUP)
+
+
+def when_ready(server):
+    # this file is read again on every HUP, so the running watcher is looked up by name rather
+    # than remembered in a module global
+    if DATA_POLL_INTERVAL > 0 and not any(t.name == WATCHER_NAME for t in threading.enumerate()):
+        threading.Thread(target=_watch_data, args=(server,), name=WATCHER_NAME, daemon=True).start()
+
+
+def on_reload(server):
+    # runs in the master's main thread after a HUP, before the new workers are forked: the changed
+    # datasets are warmed here, so the fresh workers inherit them; unchanged ones are cache hits
+    import wsgi
+    wsgi.dm.preload()
@@ -0,0 +1,7 @@
+from app import app, dm
+
+# imported once by the server's master process (preload_app), so every worker
+# forks with the datasets already loaded and shares their pages copy-on-write
+dm.preload()
+
+application = app